@@ -0,0 +1,575 @@
+import asyncio
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl
+
+import numpy as np
+
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class AudioSource:
+    """Base class for the audio that drives the music painters.
+
+    A source delivers mono blocks of hop int16-scaled float32 samples
+    from a capture thread. It keeps the most recent history samples
+    for analysis windows, wakes next_block() waiters on each block and
+    runs an optional dsp.SilenceGate.
+
+    Subclasses implement _open_stream(), _read_block() and
+    _close_stream(). _open_stream() raises OSError if the source isn't
+    available (it is retried with exponential backoff), _read_block()
+    raises IOError if the stream is lost (it is reopened) or EOFError
+    when there is no more audio (capture stops).
+
+    The stream is kept open for linger seconds after the last client
+    leaves so a quick resubscribe (eg the next track) doesn't pay for
+    restarting it.
+    """
+    # Capture states
+    CLOSED = "closed"
+    OPEN = "open"
+    RETRYING = "retrying"
+    FAILED = "failed"
+
+    def __init__(self, mic_rate, hop, history=None, linger=0, gate=None):
+        self.mic_rate = mic_rate
+        self.frames_per_buffer = int(hop)
+        logger.debug("working on %s Hz and %s frames",
+                     mic_rate, self.frames_per_buffer)
+        self.stream = None
+        # It's written from the run_in_executor Thread and read from
+        # the async main thread so it needs locking to avoid reading
+        # whilst it's being written
+        self._audiodata = None
+        self._history = np.zeros(max(int(history or hop), self.frames_per_buffer),
+                                 dtype=np.float32)
+        self._audiodata_lock = threading.Lock()
+        self.gate = gate
+        # Sequence number of the latest block. Waiters in next_block()
+        # are woken through _block_event from the capture thread.
+        self.seq = 0
+        self._loop = None
+        self._block_event = None
+
+        # This is used to lock access to the stream when closing
+        # because it's likely blocking in the other thread
+        self._p_lock = threading.Lock()
+
+        # This is used to lock access to the client list
+        self._c_lock = threading.Lock()
+
+        self.stream_playing_task = None
+        self.stream_stop_playing = False
+        # Set to wake the capture thread from a retry backoff
+        self._stop_event = threading.Event()
+
+        self.state = self.CLOSED
+        self.retry_delay = 0.5
+        self.max_retry_delay = 30.0
+        # After this many failed opens painters are told to give up
+        # although the thread keeps trying at max_retry_delay
+        self.max_attempts = 6
+
+        # Keep a record of clients so we can stop the stream if we
+        # have none left
+        self.clients = {}
+        self.linger = linger
+        self._linger_task = None
+        # Used to log how long after a subscribe audio arrives
+        self._subscribed_at = None
+
+    @property
+    def audiodata(self):
+        with self._audiodata_lock:
+            if self._audiodata is None:
+                logger.debug("No frame yet")
+                return None
+            c = self._audiodata.copy()
+            return c
+
+    async def next_block(self, seq, timeout=None):
+        """Wait until a block newer than seq has been captured and
+        return its sequence number, or None on timeout"""
+        if self._block_event is None:
+            self._block_event = asyncio.Event()
+        try:
+            while self.seq == seq:
+                await asyncio.wait_for(self._block_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.seq
+
+    def _notify_block(self):
+        # Runs in the event loop. Waiters hold the old event so swap
+        # in a fresh one for the next block before waking them
+        event = self._block_event
+        self._block_event = asyncio.Event()
+        if event is not None:
+            event.set()
+
+    @property
+    def silent(self):
+        """True whilst the gate reports the audio as silent"""
+        return self.gate is not None and self.gate.silent
+
+    def recent(self, n):
+        """Return a copy of the last n captured samples (at most the
+        history size) or None if nothing has been captured yet"""
+        with self._audiodata_lock:
+            if self._audiodata is None:
+                return None
+            return self._history[-n:].copy()
+
+    async def subscribe_stream(self, client):
+        with self._c_lock:
+            if self._linger_task and not self._linger_task.done():
+                logger.debug("Reusing lingering stream")
+                self._linger_task.cancel()
+            self._linger_task = None
+            self.stream_stop_playing = False
+            self._stop_event.clear()
+            if not self.clients:
+                self._subscribed_at = time.monotonic()
+
+            if not self.stream_playing_task or self.stream_playing_task.done():
+                logger.debug("Starting stream for %s in a thread", self)
+                loop = asyncio.get_event_loop()
+                self._loop = loop
+                self.stream_playing_task = loop.run_in_executor(None, self._run_stream)
+            # Add this client
+            self.clients[client] = True
+            logger.debug("mic has %s clients after subscribe", len(self.clients))
+
+    async def unsubscribe_stream(self, client):
+        with self._c_lock:
+            # Remove this client
+            try:
+                del self.clients[client]
+            except KeyError:
+                logger.warn("Client already unsubscribed")
+                pass
+            if not self.clients:
+                if self.linger > 0:
+                    logger.debug("No clients, stream lingers for %ss",
+                                 self.linger)
+                    self._linger_task = asyncio.ensure_future(
+                        self._stop_after_linger())
+                else:
+                    self.stream_stop_playing = True
+                    self._stop_event.set()
+                    await self.stream_playing_task
+            logger.debug("mic has %s clients after unsubscribe", len(self.clients))
+
+    async def _stop_after_linger(self):
+        await asyncio.sleep(self.linger)
+        with self._c_lock:
+            if self.clients:
+                return
+            logger.debug("Stream lingered for %ss, stopping", self.linger)
+            self.stream_stop_playing = True
+            self._stop_event.set()
+        await self.stream_playing_task
+
+    def _run_stream(self):
+        while not self.stream_stop_playing:
+            if not self._ensure_stream():
+                break
+            self._start_stream()
+            if not self._read_stream():
+                break
+            # The source went away; drop the stream and open it again
+            logger.warning("Lost audio stream %s", self)
+            with self._p_lock:
+                try:
+                    self._close_stream()
+                except OSError:
+                    pass
+                self.stream = None
+            self._lost_stream()
+        if self.stream is not None:
+            self._stop_stream()
+        self.state = self.CLOSED
+        logger.debug("Thread exiting for %s", self)
+
+    def _read_stream(self):
+        """Read blocks until asked to stop or the audio ends (returns
+        False) or the stream fails (returns True)"""
+        while True:
+            try:
+                with self._p_lock:
+                    if self.stream_stop_playing:
+                        logger.debug("_run_stream exiting as asked")
+                        return False
+                    with tracer.span("audio.read", "audio"):
+                        y = self._read_block()
+            except EOFError:
+                logger.debug("_run_stream reached the end of the audio")
+                return False
+            except IOError as e:
+                logger.debug("_run_stream read failed: %s", e)
+                return True
+            self._store_block(y)
+
+    def _store_block(self, y):
+        if self.gate is not None:
+            was_silent = self.gate.silent
+            if self.gate.update(y) != was_silent:
+                logger.debug("Audio is %s",
+                             "silent" if self.gate.silent else "back")
+        if self._subscribed_at is not None:
+            logger.debug("First audio %.1fms after subscribe",
+                         (time.monotonic() - self._subscribed_at) * 1000)
+            self._subscribed_at = None
+        with self._audiodata_lock:
+            self._audiodata = y
+            h = self._history
+            n = min(len(y), len(h))
+            h[:-n] = h[n:]
+            h[-n:] = y[-n:]
+            self.seq += 1
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._notify_block)
+            except RuntimeError:
+                # The loop has gone away under us
+                pass
+
+    def _ensure_stream(self):
+        """Open the stream, backing off exponentially between
+        attempts. Returns False if asked to stop whilst waiting."""
+        delay = self.retry_delay
+        attempts = 0
+        while self.stream is None:
+            if self.stream_stop_playing:
+                return False
+            logger.debug("No stream available, making one")
+            try:
+                with self._p_lock:
+                    self._open_stream()
+            except OSError as e:
+                attempts += 1
+                self.state = (self.RETRYING if attempts < self.max_attempts
+                              else self.FAILED)
+                logger.debug("Error opening stream %s (attempt %d, %s), "
+                             "retrying in %.1fs", e, attempts, self.state,
+                             delay)
+                self._lost_stream()
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+        self.state = self.OPEN
+        return True
+
+    def _wait(self, delay):
+        """Sleep in the capture thread but wake if asked to stop"""
+        if delay > 0:
+            self._stop_event.wait(delay)
+
+    def _open_stream(self):
+        """Set self.stream or raise OSError. Called with _p_lock held"""
+        raise NotImplementedError
+
+    def _read_block(self):
+        """Return the next block of frames_per_buffer samples"""
+        raise NotImplementedError
+
+    def _close_stream(self):
+        pass
+
+    def _start_stream(self):
+        pass
+
+    def _stop_stream(self):
+        pass
+
+    def _lost_stream(self):
+        """Called when opening or reading the stream fails"""
+        pass
+
+    async def pause_stream(self):
+        logger.debug("Pausing stream for %s in a thread", self)
+        #return
+        if self.stream is not None:
+            self.stream_stop_playing = True
+            self._stop_event.set()
+            await self.stream_playing_task
+
+    async def close(self):
+        logger.debug("Closing mic %s", self)
+        if self._linger_task:
+            self._linger_task.cancel()
+        if self.stream_playing_task:
+            logger.debug("Waiting for stream_playing_task thread")
+            self.stream_stop_playing = True
+            self._stop_event.set()
+            await self.stream_playing_task
+        if self.stream is not None:
+            with self._p_lock:
+                self._close_stream()
+                self.stream = None
+        logger.debug("Mic is closed")
+
+
+def _to_mono(frames, channels):
+    """int16 frames (interleaved if channels > 1) as mono float32"""
+    if channels == 1:
+        return frames.astype(np.float32)
+    return frames.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+
+
+def wav_layout(path):
+    """Return (data offset, data bytes, channels, sample rate) of a 16
+    bit PCM WAV file"""
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise OSError(f"{path} is not a WAV file")
+        channels = rate = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise OSError(f"{path} has no data chunk")
+            chunk, size = struct.unpack("<4sI", header)
+            if chunk == b"fmt ":
+                fmt, channels, rate, _, _, bits = struct.unpack(
+                    "<HHIIHH", f.read(16))
+                if fmt != 1 or bits != 16:
+                    raise OSError(f"{path} is not 16 bit PCM")
+                f.seek(size - 16, os.SEEK_CUR)
+            elif chunk == b"data":
+                if channels is None:
+                    raise OSError(f"{path} has no fmt chunk")
+                return f.tell(), size, channels, rate
+            else:
+                f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+class FileSource(AudioSource):
+    """Plays a WAV or raw s16le PCM file through np.memmap.
+
+    Blocks are delivered at real-time speed unless realtime is False
+    in which case they come as fast as they can be read (useful for
+    profiling; waiters then see only the latest block). At the end of
+    the file it loops unless loop is False.
+    """
+    def __init__(self, path, mic_rate, hop, realtime=True, loop=True,
+                 channels=1, **kwargs):
+        super().__init__(mic_rate, hop, **kwargs)
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.channels = channels
+        self._pos = 0
+        self._next_block = 0
+
+    def __repr__(self):
+        return f"<FileSource {self.path}>"
+
+    def _open_stream(self):
+        if self.path.endswith(".wav"):
+            offset, size, self.channels, rate = wav_layout(self.path)
+            if rate != self.mic_rate:
+                logger.warning("%s is %d Hz but analysis expects %d Hz",
+                               self.path, rate, self.mic_rate)
+        else:
+            offset = 0
+            size = os.path.getsize(self.path)
+        frames = size // (2 * self.channels)
+        if frames < self.frames_per_buffer:
+            raise OSError(f"{self.path} is shorter than one block")
+        self.stream = np.memmap(self.path, dtype="<i2", mode="r",
+                                offset=offset, shape=(frames * self.channels,))
+        self._pos = 0
+        self._next_block = time.monotonic()
+
+    def _start_stream(self):
+        # Pace from now like a device would rather than rushing out
+        # the blocks "missed" whilst stopped
+        self._next_block = time.monotonic()
+
+    def _read_block(self):
+        n = self.frames_per_buffer * self.channels
+        if self._pos + n > len(self.stream):
+            if not self.loop:
+                raise EOFError()
+            self._pos = 0
+        block = _to_mono(self.stream[self._pos:self._pos + n], self.channels)
+        self._pos += n
+        if self.realtime:
+            self._next_block += self.frames_per_buffer / self.mic_rate
+            self._wait(self._next_block - time.monotonic())
+        return block
+
+    def _close_stream(self):
+        self.stream = None
+
+
+class PipeSource(AudioSource):
+    """Reads s16le PCM from a FIFO or stdin (path "-").
+
+    This can be fed directly by mpd, avoiding the ALSA loopback, with
+    an output like:
+
+        audio_output {
+            type    "fifo"
+            name    "lamp"
+            path    "/tmp/lamp.fifo"
+            format  "48000:16:1"
+        }
+
+    If nothing arrives for a couple of blocks (eg mpd is paused or
+    not connected) silent blocks are delivered every couple of block
+    times so the silence gate and painters behave as they do with the
+    loopback.
+    """
+    def __init__(self, path, mic_rate, hop, channels=1, **kwargs):
+        super().__init__(mic_rate, hop, **kwargs)
+        self.path = path
+        self.channels = channels
+        self._fd = None
+        nbytes = self.frames_per_buffer * channels * 2
+        self._buf = bytearray(nbytes)
+        self._silence = np.zeros(self.frames_per_buffer, dtype=np.float32)
+
+    def __repr__(self):
+        return f"<PipeSource {self.path}>"
+
+    def _open_stream(self):
+        if self.path == "-":
+            self._fd = sys.stdin.buffer.fileno()
+        else:
+            # Non-blocking so we don't hang here waiting for a writer
+            self._fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self.stream = self._fd
+
+    def _read_block(self):
+        view = memoryview(self._buf)
+        got = 0
+        timeout = 2 * self.frames_per_buffer / self.mic_rate
+        while got < len(self._buf):
+            if self.stream_stop_playing:
+                raise EOFError()
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if not ready:
+                if got == 0:
+                    return self._silence
+                continue
+            try:
+                chunk = os.read(self._fd, len(self._buf) - got)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                if self.path == "-":
+                    raise EOFError()
+                # No writer on the FIFO; one may connect later
+                self._wait(timeout / 2)
+                if got == 0:
+                    return self._silence
+                continue
+            view[got:got + len(chunk)] = chunk
+            got += len(chunk)
+        return _to_mono(np.frombuffer(self._buf, dtype="<i2"), self.channels)
+
+    def _close_stream(self):
+        if self._fd is not None and self.path != "-":
+            os.close(self._fd)
+        self._fd = None
+
+
+class SyntheticSource(AudioSource):
+    """Generates a test signal: a tone with clicks on the beat over
+    seeded noise. Amplitudes are relative to full scale."""
+    def __init__(self, mic_rate, hop, freq=220.0, bpm=120.0, tone=0.1,
+                 click=0.6, noise=0.02, seed=0, realtime=True, **kwargs):
+        super().__init__(mic_rate, hop, **kwargs)
+        self.freq = freq
+        self.bpm = bpm
+        self.tone = tone
+        self.click = click
+        self.noise = noise
+        self.realtime = realtime
+        self.rng = np.random.default_rng(seed)
+        self._t = 0
+        self._next_block = 0
+        click_t = np.arange(int(0.1 * mic_rate)) / mic_rate
+        self._click = np.sin(2 * np.pi * 80 * click_t) * np.exp(-click_t * 30)
+
+    def __repr__(self):
+        return "<SyntheticSource>"
+
+    def _open_stream(self):
+        self.stream = True
+        self._next_block = time.monotonic()
+
+    def _start_stream(self):
+        self._next_block = time.monotonic()
+
+    def _read_block(self):
+        n = self.frames_per_buffer
+        t = self._t + np.arange(n)
+        y = self.tone * np.sin(2 * np.pi * self.freq * t / self.mic_rate)
+        y += self.rng.normal(0.0, self.noise, n)
+        if self.bpm:
+            beat = int(self.mic_rate * 60 / self.bpm)
+            since = t % beat
+            clicking = since < len(self._click)
+            y[clicking] += self.click * self._click[since[clicking]]
+        self._t += n
+        if self.realtime:
+            self._next_block += n / self.mic_rate
+            self._wait(self._next_block - time.monotonic())
+        return (np.clip(y, -1, 1) * 32767).astype(np.float32)
+
+
+def _flag(value):
+    return value.lower() not in ("0", "false", "no", "off")
+
+
+def create_source(spec, mic_rate, hop, **kwargs):
+    """Make an AudioSource from a spec string:
+
+        pyaudio                      the Loopback capture device
+        file:<path>[?realtime=0&loop=0]  a .wav or raw s16le file
+        pipe:<path>                  a FIFO, or stdin for pipe:-
+        synthetic[?bpm=120&seed=1]   a generated test signal
+        remote:udp://<group>:<port>  frames analysed by a Broadcaster
+        remote:mqtt:<topic>          elsewhere (see broadcast.py)
+
+    Other keyword arguments are passed to the AudioSource.
+    """
+    kind, _, rest = spec.partition(":")
+    if kind == "remote":
+        from broadcast import RemoteSource
+        return RemoteSource(rest)
+    if "?" in kind:
+        kind, _, rest = spec.partition("?")
+        rest = "?" + rest
+    target, _, query = rest.partition("?")
+    options = dict(parse_qsl(query))
+    for name in ("realtime", "loop"):
+        if name in options:
+            options[name] = _flag(options[name])
+    for name in ("channels", "seed"):
+        if name in options:
+            options[name] = int(options[name])
+    for name in ("freq", "bpm", "tone", "click", "noise"):
+        if name in options:
+            options[name] = float(options[name])
+    kwargs.update(options)
+    if kind == "pyaudio":
+        from microphone import Microphone
+        return Microphone(mic_rate, hop, **kwargs)
+    if kind == "file":
+        return FileSource(target, mic_rate, hop, **kwargs)
+    if kind == "pipe":
+        return PipeSource(target or "-", mic_rate, hop, **kwargs)
+    if kind == "synthetic":
+        return SyntheticSource(mic_rate, hop, **kwargs)
+    raise ValueError(f"Unknown audio source {spec}")
@@ -0,0 +1,349 @@
+import asyncio
+import ipaddress
+import logging
+import socket
+import struct
+import time
+
+import numpy as np
+
+import config
+import dsp
+
+logger = logging.getLogger(__name__)
+
+################################################################
+# Frame records
+#
+# Each analysed frame is sent as one binary record: a fixed header
+# followed by the mel vector as float16 or as uint8 scaled by the
+# header's scale (the largest value in the frame). 50 bins as uint8
+# is 88 bytes.
+HEADER = struct.Struct("!2sBBBBIdfffff")
+MAGIC = b"LM"
+VERSION = 1
+FORMATS = {"float16": 0, "uint8": 1}
+SILENT = 1
+ONSET = 2
+BEAT = 4
+
+
+class Frame:
+    """An unpacked record"""
+    __slots__ = ("seq", "timestamp", "mel", "volume", "strength", "phase",
+                 "tempo", "silent", "onset", "beat")
+
+
+def pack_frame(seq, mel, volume=0.0, rhythm=None, silent=False,
+               fmt="uint8", timestamp=None):
+    """Pack an analysed frame (mel may be None when silent) into a
+    record. rhythm is the dsp.OnsetDetector of the analysis."""
+    mel = np.zeros(0, dtype=np.float32) if mel is None else mel
+    flags = SILENT if silent else 0
+    strength = phase = tempo = 0.0
+    if rhythm is not None:
+        flags |= (ONSET if rhythm.onset else 0) | (BEAT if rhythm.beat else 0)
+        strength, phase, tempo = rhythm.strength, rhythm.phase, rhythm.tempo
+    if fmt == "uint8":
+        scale = float(np.max(mel)) if len(mel) else 0.0
+        data = np.zeros(len(mel), dtype=np.uint8)
+        if scale > 0:
+            np.rint(mel * (255.0 / scale), out=data, casting="unsafe")
+    else:
+        scale = 1.0
+        data = mel.astype(">f2")
+    header = HEADER.pack(MAGIC, VERSION, FORMATS[fmt], flags, len(mel),
+                         seq & 0xffffffff,
+                         time.time() if timestamp is None else timestamp,
+                         volume, strength, phase, tempo, scale)
+    return header + data.tobytes()
+
+
+def unpack_frame(record):
+    """Unpack a record into a Frame, raising ValueError if it isn't one"""
+    try:
+        (magic, version, fmt, flags, n_bins, seq, timestamp, volume,
+         strength, phase, tempo, scale) = HEADER.unpack_from(record)
+    except struct.error:
+        raise ValueError("Short analysis record")
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not an analysis record")
+    body = record[HEADER.size:]
+    if fmt == FORMATS["uint8"]:
+        mel = np.frombuffer(body, dtype=np.uint8, count=n_bins)
+        mel = mel.astype(np.float32) * (scale / 255.0)
+    else:
+        mel = np.frombuffer(body, dtype=">f2", count=n_bins)
+        mel = mel.astype(np.float32)
+    frame = Frame()
+    frame.seq = seq
+    frame.timestamp = timestamp
+    frame.mel = mel
+    frame.volume = volume
+    frame.strength = strength
+    frame.phase = phase
+    frame.tempo = tempo
+    frame.silent = bool(flags & SILENT)
+    frame.onset = bool(flags & ONSET)
+    frame.beat = bool(flags & BEAT)
+    return frame
+
+
+################################################################
+# Transports
+#
+# Addresses are "udp://<group>:<port>" for UDP multicast or
+# "mqtt:<topic>" for MQTT.
+def _udp_address(address):
+    host, _, port = address[len("udp://"):].rpartition(":")
+    return host, int(port)
+
+
+class UdpSender:
+    """Sends records to a multicast group"""
+
+    def __init__(self, address, ttl=1):
+        self.group = _udp_address(address)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                  socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setblocking(False)
+
+    def __call__(self, record):
+        try:
+            self.sock.sendto(record, self.group)
+        except OSError as e:
+            # Dropping a frame is better than stalling the analysis
+            logger.debug("Analysis send failed: %s", e)
+
+
+def create_sender(address, mqtt_publish=None):
+    """Return a function which sends a record to address"""
+    if address.startswith("udp://"):
+        return UdpSender(address)
+    if address.startswith("mqtt:"):
+        if mqtt_publish is None:
+            raise ValueError("MQTT broadcast needs an MQTT connection")
+        topic = address[len("mqtt:"):]
+        return lambda record: mqtt_publish(topic, record)
+    raise ValueError(f"Unknown broadcast address {address}")
+
+
+class Broadcaster:
+    """Analyses audio from an AudioSource and sends every frame.
+
+    The analysis is the shared dsp.Analysis so local music shows with
+    the same settings don't analyse twice. Whilst the source is silent
+    a silent record is sent at config.IDLE_FPS so receivers idle too.
+    """
+
+    def __init__(self, source, analysis, send, fmt="uint8"):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown analysis format {fmt}")
+        self.source = source
+        self.analysis = analysis
+        self.send = send
+        self.fmt = fmt
+        self.frames = 0
+
+    async def run(self):
+        source = self.source
+        window = self.analysis.window_size
+        hop = source.frames_per_buffer
+        await source.subscribe_stream(self)
+        try:
+            seq = source.seq
+            last_silent = 0.0
+            while True:
+                if await source.next_block(seq, timeout=1.0) is None:
+                    continue
+                seq = source.seq
+                if source.silent:
+                    now = time.monotonic()
+                    if now - last_silent >= 1.0 / config.IDLE_FPS:
+                        last_silent = now
+                        self.send(pack_frame(seq, None, silent=True,
+                                             fmt=self.fmt))
+                    continue
+                samples = source.recent(window)
+                mel = self.analysis.update(samples, seq)
+                block = samples[-hop:] / 2.0**15
+                volume = float(np.sqrt(np.mean(block * block)))
+                self.send(pack_frame(seq, mel, volume, self.analysis.rhythm,
+                                     fmt=self.fmt))
+                self.frames += 1
+        finally:
+            await source.unsubscribe_stream(self)
+
+
+################################################################
+# Receiving
+_mqtt_sources = {}
+
+
+def deliver(topic, payload):
+    """Hand an MQTT message to the RemoteSource listening on topic.
+    Returns False if there isn't one."""
+    source = _mqtt_sources.get(topic)
+    if source is None:
+        return False
+    source.receive(payload)
+    return True
+
+
+class RemoteRhythm:
+    """The rhythm fields of the last received frame, standing in for
+    a dsp.OnsetDetector"""
+    strength = 0.0
+    onset = False
+    beat = False
+    phase = 0.0
+    tempo = 120.0
+
+
+class RemoteAnalysis:
+    """Stands in for a dsp.Analysis in a MusicShow fed by a
+    RemoteSource. update() returns the received mel spectrum
+    resampled to the show's number of bins."""
+
+    def __init__(self, source, n_bins):
+        self.source = source
+        self.n_bins = n_bins
+        self.rhythm = source.rhythm
+
+    def update(self, audio_samples=None, seq=None):
+        mel = self.source.mel
+        if len(mel) != self.n_bins:
+            mel = dsp.resample(mel, self.n_bins, "area")
+        return mel
+
+
+class RemoteSource:
+    """An audio source for MusicShow which receives frames analysed
+    by a Broadcaster elsewhere rather than capturing audio.
+
+    It offers the parts of the AudioSource interface MusicShow uses;
+    recent() returns None as there are no samples and analysis_for()
+    replaces the local analysis. address is "udp://<group>:<port>" or
+    "mqtt:<topic>"; for MQTT the StripPlayer passes messages in
+    through deliver().
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    FAILED = "failed"
+
+    def __init__(self, address, **kwargs):
+        self.address = address
+        self.seq = 0
+        self.state = self.CLOSED
+        self.mel = np.zeros(config.N_FFT_BINS, dtype=np.float32)
+        self.rhythm = RemoteRhythm()
+        self.volume = 0.0
+        self.timestamp = 0.0
+        self._silent = True
+        self._last_seq = None
+        self._block_event = None
+        self._transport = None
+        self.dropped = 0
+        if address.startswith("mqtt:"):
+            _mqtt_sources[address[len("mqtt:"):]] = self
+        elif not address.startswith("udp://"):
+            raise ValueError(f"Unknown remote address {address}")
+
+    def __repr__(self):
+        return f"RemoteSource({self.address})"
+
+    @property
+    def silent(self):
+        return self._silent
+
+    def recent(self, n):
+        return None
+
+    def analysis_for(self, n_bins):
+        return RemoteAnalysis(self, n_bins)
+
+    async def next_block(self, seq, timeout=None):
+        """Wait for a frame newer than seq, as AudioSource.next_block()"""
+        if self._block_event is None:
+            self._block_event = asyncio.Event()
+        try:
+            while self.seq == seq:
+                await asyncio.wait_for(self._block_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.seq
+
+    def receive(self, record):
+        try:
+            frame = unpack_frame(record)
+        except ValueError as e:
+            logger.debug("Ignoring record: %s", e)
+            return
+        if self._last_seq is not None:
+            # Frames can arrive out of order over UDP; drop old ones
+            gap = (frame.seq - self._last_seq) & 0xffffffff
+            if gap == 0 or gap > 0x7fffffff:
+                return
+            self.dropped += gap - 1
+        self._last_seq = frame.seq
+        self.state = self.OPEN
+        self._silent = frame.silent
+        self.timestamp = frame.timestamp
+        self.volume = frame.volume
+        if not frame.silent:
+            self.mel = frame.mel
+            rhythm = self.rhythm
+            rhythm.strength = frame.strength
+            rhythm.onset = frame.onset
+            rhythm.beat = frame.beat
+            rhythm.phase = frame.phase
+            rhythm.tempo = frame.tempo
+        self.seq += 1
+        event = self._block_event
+        self._block_event = asyncio.Event()
+        if event is not None:
+            event.set()
+
+    async def subscribe_stream(self, client):
+        if self._transport is None and self.address.startswith("udp://"):
+            self._transport = await listen_udp(self.address, self.receive)
+            logger.info("Listening for analysis on %s", self.address)
+
+    async def unsubscribe_stream(self, client):
+        # Receiving costs next to nothing so keep listening
+        pass
+
+    async def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        self.state = self.CLOSED
+
+
+class _Receiver(asyncio.DatagramProtocol):
+    def __init__(self, receive):
+        self.receive = receive
+
+    def datagram_received(self, data, addr):
+        self.receive(data)
+
+
+async def listen_udp(address, receive):
+    """Call receive(data) for each datagram sent to address
+    ("udp://<host>:<port>"), joining the group if host is a multicast
+    address. Returns the transport; close() it to stop."""
+    host, port = _udp_address(address)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                         socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if host and ipaddress.ip_address(host).is_multicast:
+        sock.bind(("", port))
+        mreq = struct.pack("4sl", socket.inet_aton(host), socket.INADDR_ANY)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    else:
+        sock.bind((host, port))
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _Receiver(receive), sock=sock)
+    return transport
@@ -82,5 +82,52 @@ There is no point using more bins than there are pixels on the LED strip.
 N_ROLLING_HISTORY = 3
 """Number of past audio frames to include in the rolling window"""
 
+MIC_HOP = None
+"""Number of audio samples captured per block (the analysis hop)
+
+None means MIC_RATE / FPS so one block arrives per rendered frame.
+Smaller hops lower the latency at the cost of more analysis work.
+"""
+
+ANALYSIS_WINDOW = None
+"""Number of audio samples in the FFT analysis window
+
+None means MIC_HOP * N_ROLLING_HISTORY. Longer windows give better
+frequency resolution but respond more slowly.
+"""
+
+AUDIO_SOURCE = "pyaudio"
+"""Where music painters get their audio; see audiosource.create_source()
+
+"pyaudio" captures from the Loopback device, "file:<path>" plays a
+.wav or raw s16le file, "pipe:<path>" reads a FIFO (eg mpd's fifo
+output) or stdin for "pipe:-" and "synthetic" generates a test signal.
+"""
+
+MIC_LINGER = 30
+"""Seconds to keep the audio stream open after the last music painter
+stops so pausing or changing track doesn't restart capture"""
+
 MIN_VOLUME_THRESHOLD = 1e-9
 """No music visualization displayed if recorded audio volume below threshold"""
+
+SILENCE_RMS = 1e-4
+"""Audio RMS (relative to full scale) below which capture counts as silent"""
+
+SOUND_RMS = 3e-4
+"""Audio RMS (relative to full scale) above which silence ends"""
+
+SILENCE_HOLD = 0.5
+"""Seconds the audio must stay below SILENCE_RMS before it is silent"""
+
+IDLE_FPS = 5
+"""Frame rate music painters drop to whilst the audio is silent"""
+
+FRAME_CACHE_BYTES = 16 * 1024 * 1024
+"""Memory budget for precomputed cycles of periodic painters"""
+
+AUDIO_SETTINGS = ("MIC_RATE", "FPS", "MIC_HOP", "ANALYSIS_WINDOW",
+                  "N_ROLLING_HISTORY", "N_FFT_BINS", "MIC_LINGER",
+                  "AUDIO_SOURCE", "MIN_FREQUENCY", "MAX_FREQUENCY",
+                  "SILENCE_RMS", "SOUND_RMS", "SILENCE_HOLD", "IDLE_FPS")
+"""Settings which may be overridden at runtime from lamp.toml"""
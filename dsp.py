@@ -1,7 +1,10 @@
 from __future__ import print_function
+from collections import OrderedDict
+from functools import lru_cache
 import numpy as np
 import config
 import melbank
+from tracing import tracer
 
 
 class ExpFilter:
@@ -25,6 +28,395 @@ class ExpFilter:
         return self.value
 
 
+class ExpFilterBank:
+    """Exponential smoothing of many channels at once.
+
+    Gives the same results as ExpFilter but works in place on
+    preallocated buffers so update() does no allocation. alpha_decay
+    and alpha_rise may be scalars or arrays which broadcast against
+    the shape of val to give each channel its own rates, eg an (n, 1)
+    array for one rate per row.
+
+    update() returns the internal value array which is overwritten
+    by the next update(); copy it if it needs to be kept.
+    """
+    def __init__(self, val, alpha_decay=0.5, alpha_rise=0.5, dtype=np.float64):
+        alpha_decay = np.asarray(alpha_decay, dtype=dtype)
+        alpha_rise = np.asarray(alpha_rise, dtype=dtype)
+        assert np.all((0.0 < alpha_decay) & (alpha_decay < 1.0)), \
+            'Invalid decay smoothing factor'
+        assert np.all((0.0 < alpha_rise) & (alpha_rise < 1.0)), \
+            'Invalid rise smoothing factor'
+        self.value = np.array(val, dtype=dtype)
+        shape = self.value.shape
+        self.alpha_decay = np.broadcast_to(alpha_decay, shape)
+        self.alpha_rise = np.broadcast_to(alpha_rise, shape)
+        self._keep_decay = 1.0 - self.alpha_decay
+        self._keep_rise = 1.0 - self.alpha_rise
+        self._rising = np.empty(shape, dtype=bool)
+        self._alpha = np.empty(shape, dtype=dtype)
+        self._keep = np.empty(shape, dtype=dtype)
+
+    def update(self, value):
+        np.greater(value, self.value, out=self._rising)
+        np.copyto(self._alpha, self.alpha_decay)
+        np.copyto(self._alpha, self.alpha_rise, where=self._rising)
+        np.copyto(self._keep, self._keep_decay)
+        np.copyto(self._keep, self._keep_rise, where=self._rising)
+        # value = alpha * value + (1 - alpha) * value, evaluated in
+        # the same order as ExpFilter so the results are identical
+        np.multiply(self._alpha, value, out=self._alpha)
+        np.multiply(self._keep, self.value, out=self.value)
+        np.add(self._alpha, self.value, out=self.value)
+        return self.value
+
+
+class OnsetDetector:
+    """Spectral flux onset detection and beat tracking on mel frames.
+
+    Call update() with each (unsmoothed) mel frame. Afterwards:
+
+    strength : half wave rectified log spectral flux of the frame
+    onset    : True if the flux jumped above the adaptive threshold
+    beat     : True on the frame a beat lands
+    phase    : 0.0 -> 1.0 position within the current beat
+    tempo    : current tempo estimate in beats per minute
+
+    Onsets are flagged on the frame they arrive with no look-ahead.
+    The tempo is the strongest autocorrelation lag of the recent
+    onset strength and the beat phase is pulled onto onsets that land
+    near an expected beat.
+    """
+    def __init__(self, n_bins, fps, history=4.0, threshold=1.5,
+                 min_bpm=60, max_bpm=180, compression=1000.0):
+        self.fps = fps
+        self.threshold = threshold
+        self.compression = compression
+        self._log = np.zeros(n_bins)
+        self._prev = np.zeros(n_bins)
+        self._flux = np.zeros(max(int(history * fps), 2))
+        self._pos = 0
+        self._mean = ExpFilter(0.0, alpha_decay=0.05, alpha_rise=0.05)
+        self._dev = ExpFilter(0.0, alpha_decay=0.05, alpha_rise=0.05)
+        self._min_lag = max(int(fps * 60 / max_bpm), 1)
+        self._max_lag = min(int(fps * 60 / min_bpm), len(self._flux) - 1)
+        # Don't flag a second onset until this many frames have passed
+        self._refractory = max(self._min_lag // 2, 1)
+        self._since_onset = self._refractory
+        self._frames = 0
+        self.period = fps / 2.0  # frames per beat, ie 120bpm
+        self.strength = 0.0
+        self.onset = False
+        self.beat = False
+        self.phase = 0.0
+
+    @property
+    def tempo(self):
+        return 60.0 * self.fps / self.period
+
+    def update(self, mel, frames=1):
+        """Update with a mel frame which is frames after the last one
+        (more than 1 if frames were skipped). The flux of the skipped
+        frames is counted in this one so the tempo and beat phase
+        keep time."""
+        frames = min(max(int(frames), 1), len(self._flux))
+        np.multiply(mel, self.compression, out=self._log)
+        np.log1p(self._log, out=self._log)
+        np.subtract(self._log, self._prev, out=self._prev)
+        flux = float(np.sum(np.maximum(self._prev, 0.0, out=self._prev)))
+        flux /= len(self._log)
+        self._prev, self._log = self._log, self._prev
+        self.strength = flux
+
+        for i in range(frames - 1):
+            self._flux[self._pos] = 0.0
+            self._pos = (self._pos + 1) % len(self._flux)
+        self._flux[self._pos] = flux
+        self._pos = (self._pos + 1) % len(self._flux)
+        last = self._frames
+        self._frames += frames
+
+        mean = self._mean.value
+        dev = self._dev.value
+        self._since_onset += frames
+        self.onset = (flux > mean + self.threshold * dev and
+                      self._since_onset > self._refractory and
+                      self._frames > 1)
+        if self.onset:
+            self._since_onset = 0
+        self._mean.update(flux)
+        self._dev.update(abs(flux - mean))
+
+        if (self._frames // self._min_lag != last // self._min_lag and
+                self._frames >= len(self._flux)):
+            self._estimate_period()
+        self._track_beat(frames)
+
+    def _estimate_period(self):
+        f = np.roll(self._flux, -self._pos)
+        f -= np.mean(f)
+        lags = np.arange(self._min_lag, self._max_lag + 1)
+        ac = np.array([np.dot(f[:-lag], f[lag:]) for lag in lags])
+        if ac.max() > 0:
+            # Move gently towards the new estimate to avoid jitter
+            self.period += 0.5 * (lags[np.argmax(ac)] - self.period)
+
+    def _track_beat(self, frames):
+        self.beat = False
+        self.phase += frames / self.period
+        if self.onset and (self.phase > 0.75 or self.phase < 0.25):
+            # The onset is close to where we expected a beat. If the
+            # beat is still to come then fire it now, either way
+            # resynchronise the phase to the onset
+            self.beat = self.phase > 0.75
+            self.phase = 0.0
+        elif self.phase >= 1.0:
+            self.beat = True
+            self.phase -= 1.0
+
+
+class SilenceGate:
+    """Detects silence from the RMS level of raw audio blocks.
+
+    Silence starts once the level has stayed below silence_rms for
+    hold_blocks blocks and ends on the first block above sound_rms.
+    Levels are relative to full scale int16.
+    """
+    def __init__(self, silence_rms, sound_rms, hold_blocks):
+        assert silence_rms <= sound_rms, 'Silence must be below sound'
+        # Compare sums of squares to avoid a sqrt per block
+        self._silence_ss = (silence_rms * 2.0**15)**2
+        self._sound_ss = (sound_rms * 2.0**15)**2
+        self.hold_blocks = hold_blocks
+        self._quiet_blocks = 0
+        self.silent = False
+
+    def update(self, block):
+        """Update with a block of int16-scaled samples and return
+        whether the audio is silent"""
+        mean_ss = float(np.dot(block, block)) / max(len(block), 1)
+        if self.silent:
+            if mean_ss > self._sound_ss:
+                self.silent = False
+                self._quiet_blocks = 0
+        elif mean_ss < self._silence_ss:
+            self._quiet_blocks += 1
+            if self._quiet_blocks >= self.hold_blocks:
+                self.silent = True
+        else:
+            self._quiet_blocks = 0
+        return self.silent
+
+
+BLUR_MATRIX_MAX_PIXELS = 128
+"""Rows up to this long are blurred by an (n, n) matrix; longer ones
+are convolved, which is faster once the matrix gets big"""
+BLUR_BLOCK = 128
+"""Pixels GaussianBlur convolves per matmul on long rows"""
+
+
+@lru_cache(maxsize=32)
+def gaussian_kernel(sigma, truncate=4.0):
+    """Normalised 1D Gaussian kernel, cached by sigma.
+
+    Uses the same radius and weights as scipy's gaussian_filter1d.
+    """
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / (sigma * sigma) * x**2)
+    kernel /= kernel.sum()
+    kernel.flags.writeable = False
+    return kernel
+
+
+def _convolve_reflect(data, kernel):
+    radius = len(kernel) // 2
+    pad = [(0, 0)] * (data.ndim - 1) + [(radius, radius)]
+    padded = np.pad(data, pad, mode='symmetric')
+    n = data.shape[-1]
+    result = kernel[0] * padded[..., :n]
+    for i in range(1, len(kernel)):
+        result += kernel[i] * padded[..., i:i + n]
+    return result
+
+
+def _reflect(data, radius, out):
+    """Copy data into out with radius values reflected at each end
+    like scipy's mode='reflect' (radius must be less than the row)"""
+    n = data.shape[-1]
+    out[..., radius:radius + n] = data
+    if radius:
+        out[..., :radius] = data[..., radius - 1::-1]
+        out[..., radius + n:] = data[..., :n - radius - 1:-1]
+    return out
+
+
+@lru_cache(maxsize=16)
+def blur_matrix(sigma, n):
+    """(n, n) matrix which applies the reflected Gaussian blur to a
+    row of n values as row @ matrix, cached by (sigma, n)"""
+    # Row i is the blurred response to an impulse at i
+    matrix = _convolve_reflect(np.eye(n), gaussian_kernel(sigma))
+    matrix.flags.writeable = False
+    return matrix
+
+
+@lru_cache(maxsize=16)
+def band_matrix(sigma, block):
+    """(block + 2 * radius, block) matrix which convolves block pixels
+    of an already reflected row with the kernel, cached by sigma"""
+    kernel = gaussian_kernel(sigma)
+    matrix = np.zeros((block + len(kernel) - 1, block))
+    for j in range(block):
+        matrix[j:j + len(kernel), j] = kernel[::-1]
+    matrix.flags.writeable = False
+    return matrix
+
+
+class GaussianBlur:
+    """Gaussian blur along the last axis of 2D arrays of one shape
+    (eg (3, N) frames) for callers which blur every frame; it owns
+    its scratch buffer and allocates nothing per call.
+
+    Rows up to BLUR_MATRIX_MAX_PIXELS are one matmul with a cached
+    blur_matrix(). Longer rows are reflected into the scratch buffer
+    and convolved BLUR_BLOCK pixels at a time by a cached
+    band_matrix().
+    """
+    def __init__(self, sigma, shape):
+        self.kernel = gaussian_kernel(sigma)
+        self.radius = len(self.kernel) // 2
+        n = shape[-1]
+        self.banded = not (n <= BLUR_MATRIX_MAX_PIXELS or self.radius >= n)
+        if not self.banded:
+            self.matrix = blur_matrix(sigma, n)
+            self._work = np.zeros(shape)
+        else:
+            self.matrix = band_matrix(sigma, BLUR_BLOCK)
+            self._work = np.zeros(tuple(shape[:-1]) + (n + 2 * self.radius,))
+
+    def __call__(self, data, out=None):
+        """Blur data into out (which may be data itself)"""
+        if out is None:
+            out = np.empty(data.shape)
+        work = self._work
+        if not self.banded:
+            np.matmul(data, self.matrix, out=work)
+            np.copyto(out, work)
+            return out
+        _reflect(data, self.radius, work)
+        n = data.shape[-1]
+        span = 2 * self.radius
+        for start in range(0, n, BLUR_BLOCK):
+            size = min(BLUR_BLOCK, n - start)
+            np.matmul(work[..., start:start + size + span],
+                      self.matrix[:size + span, :size],
+                      out=out[..., start:start + size])
+        return out
+
+
+def blur(data, sigma, out=None):
+    """Gaussian blur along the last axis of data.
+
+    A (3, N) frame is blurred row by row in a single call. Edges are
+    reflected like scipy's gaussian_filter1d (mode='reflect') which
+    this replaces. out may be data itself. Use a GaussianBlur to blur
+    the same shape every frame without allocating.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[-1]
+    kernel = gaussian_kernel(sigma)
+    radius = len(kernel) // 2
+    if n <= BLUR_MATRIX_MAX_PIXELS or radius >= n:
+        matrix = blur_matrix(sigma, n)
+        if out is data or (out is not None and np.shares_memory(out, data)):
+            np.copyto(out, data @ matrix)
+            return out
+        return np.matmul(data, matrix, out=out)
+    work = _reflect(data, radius,
+                    np.empty(data.shape[:-1] + (n + 2 * radius,)))
+    if out is None:
+        out = np.empty(data.shape)
+    for i in np.ndindex(data.shape[:-1]):
+        out[i] = np.convolve(work[i], kernel, "valid")
+    return out
+
+
+RESAMPLE_MODES = ("linear", "log", "area")
+
+
+def _positions(n_in, n_out, mode):
+    """Where each of n_out outputs samples the n_in inputs, in input
+    bin units"""
+    if mode == "log":
+        # Low bins are spread over more pixels than high ones
+        return np.geomspace(1, n_in, n_out) - 1
+    return np.linspace(0, n_in - 1, n_out)
+
+
+@lru_cache(maxsize=32)
+def resample_matrix(n_in, n_out, mode="linear"):
+    """(n_in, n_out) weight matrix mapping n_in values onto n_out as
+    values @ matrix, cached by (n_in, n_out, mode).
+
+    linear matches np.interp over evenly spaced points (the old
+    interpolate()), log spaces the samples logarithmically across the
+    inputs and area averages the inputs each output covers.
+    """
+    if mode not in RESAMPLE_MODES:
+        raise ValueError(f"Unknown resample mode {mode}")
+    matrix = np.zeros((n_in, n_out))
+    if mode == "area":
+        # Overlap of input bin i [i, i+1) with output j scaled to the
+        # same range
+        edges = np.linspace(0, n_in, n_out + 1)
+        lo = np.maximum(np.arange(n_in)[:, None], edges[None, :-1])
+        hi = np.minimum(np.arange(1, n_in + 1)[:, None], edges[None, 1:])
+        matrix = np.clip(hi - lo, 0, None)
+        matrix /= matrix.sum(axis=0)
+    elif n_in == 1:
+        matrix[0] = 1.0
+    else:
+        pos = _positions(n_in, n_out, mode)
+        i = np.minimum(pos.astype(int), n_in - 2)
+        frac = pos - i
+        cols = np.arange(n_out)
+        matrix[i, cols] = 1.0 - frac
+        matrix[i + 1, cols] += frac
+    matrix.flags.writeable = False
+    return matrix
+
+
+def resample(data, n_out, mode="linear", out=None):
+    """Map data (last axis) onto n_out values using a cached
+    resample_matrix(); eg a mel spectrum onto the pixels of a strip"""
+    return np.matmul(data, resample_matrix(data.shape[-1], n_out, mode),
+                     out=out)
+
+
+@lru_cache(maxsize=32)
+def band_edges(n, n_bands):
+    """Start indices and sizes of n_bands contiguous bands over n
+    values, split like y[:n // 3], y[n // 3: 2 * n // 3], ..."""
+    edges = np.arange(n_bands) * n // n_bands
+    sizes = np.diff(edges, append=n)
+    edges.flags.writeable = False
+    sizes.flags.writeable = False
+    return edges, sizes
+
+
+def band_max(data, n_bands):
+    """Maximum of each of n_bands bands along the last axis"""
+    edges, _ = band_edges(data.shape[-1], n_bands)
+    return np.maximum.reduceat(data, edges, axis=-1)
+
+
+def band_mean(data, n_bands):
+    """Mean of each of n_bands bands along the last axis"""
+    edges, sizes = band_edges(data.shape[-1], n_bands)
+    return np.add.reduceat(data, edges, axis=-1) / sizes
+
+
 def rfft(data, window=None):
     window = 1.0 if window is None else window(len(data))
     ys = np.abs(np.fft.rfft(data * window))
@@ -39,9 +431,169 @@ def fft(data, window=None):
     return xs, ys
 
 
+def hop_samples():
+    """Number of audio samples in each captured block"""
+    return int(config.MIC_HOP or config.MIC_RATE / config.FPS)
+
+
+def window_samples():
+    """Number of audio samples in the analysis window"""
+    return int(config.ANALYSIS_WINDOW or
+               hop_samples() * config.N_ROLLING_HISTORY)
+
+
+def latency(fps=None):
+    """Estimated audio to light latency in seconds and its parts.
+
+    A sound waits on average half a block to be captured, the
+    Hamming window centres the analysis half a window in the past and
+    the result waits on average half a frame to be rendered.
+    """
+    fps = fps or config.FPS
+    parts = {
+        "capture": hop_samples() / config.MIC_RATE / 2,
+        "window": window_samples() / config.MIC_RATE / 2,
+        "render": 1.0 / fps / 2,
+    }
+    return sum(parts.values()), parts
+
+
+def configure(settings):
+    """Apply any AUDIO_SETTINGS found in settings (eg the lamp.toml
+    dict) to config and rebuild the mel bank to match"""
+    changed = False
+    for name in config.AUDIO_SETTINGS:
+        if name in settings and getattr(config, name) != settings[name]:
+            setattr(config, name, settings[name])
+            changed = True
+    if changed:
+        create_mel_bank()
+        _analyses.clear()
+    return changed
+
+
+@lru_cache(maxsize=8)
+def mel_bank(n_bins, freq_min, freq_max, num_fft_bands, sample_rate):
+    """Mel matrix for the given parameters from a bounded registry so
+    analyses with equal settings share one (read only) matrix"""
+    melmat, _ = melbank.compute_melmat(num_mel_bands=n_bins,
+                                       freq_min=freq_min,
+                                       freq_max=freq_max,
+                                       num_fft_bands=num_fft_bands,
+                                       sample_rate=sample_rate)
+    melmat.flags.writeable = False
+    return melmat
+
+
+# numpy 2.0 added out= to the FFTs
+_RFFT_OUT = np.lib.NumpyVersion(np.__version__) >= "2.0.0"
+
+
+class Analysis:
+    """Turns windows of audio into gain normalised, smoothed mel
+    spectra for one set of analysis parameters.
+
+    Shows with the same parameters share an Analysis (see
+    analysis_for()) so when update() is given the block sequence
+    number the work is only done once per block. The returned mel
+    array is shared and must not be modified.
+
+    The FFT works in float32 buffers owned by the analysis: the
+    window (with the int16 scaling folded in) is applied straight
+    into the zero padded FFT input, and the FFT output, magnitudes
+    and mel bands are written in place, so a frame allocates nothing
+    large. numpy before 2.0 has no rfft(out=) and computes the FFT in
+    float64, which costs one allocation.
+    """
+    def __init__(self, n_bins, freq_min, freq_max, window_size, sample_rate,
+                 smoothing=(0.5, 0.99), hop=None):
+        self.n_bins = n_bins
+        self.window_size = window_size
+        fft_size = 2**int(np.ceil(np.log2(window_size)))
+        self.fft_window = (np.hamming(window_size) / 2.0**15).astype(np.float32)
+        self.mel_y = mel_bank(n_bins, freq_min, freq_max,
+                              window_size // 2, sample_rate)
+        # FFT workspace
+        self._fft_in = np.zeros(fft_size, dtype=np.float32)
+        self._fft_out = np.zeros(fft_size // 2 + 1, dtype=np.complex64)
+        self._magnitude = np.zeros(window_size // 2, dtype=np.float32)
+        self._mel_t = np.ascontiguousarray(self.mel_y.T, dtype=np.float32)
+        self._mel = np.zeros(n_bins, dtype=np.float32)
+        self.mel_gain = ExpFilter(np.tile(1e-1, n_bins),
+                                  alpha_decay=0.01, alpha_rise=0.99)
+        decay, rise = smoothing
+        self.mel_smoothing = ExpFilterBank(np.tile(1e-1, n_bins),
+                                           alpha_decay=decay, alpha_rise=rise)
+        # Onset strength, beat flag and phase for painters to read.
+        # It keeps time in captured blocks of hop samples whatever
+        # rate the sharing shows analyse at.
+        self.rhythm = OnsetDetector(n_bins,
+                                    sample_rate / (hop or hop_samples()))
+        self.mel = None
+        self._seq = None
+
+    def update(self, audio_samples, seq=None):
+        """Return the mel spectrum of a window of audio samples,
+        reusing the last result if seq is the block already analysed"""
+        if seq is not None and seq == self._seq:
+            return self.mel
+        frames = 1
+        if seq is not None and self._seq is not None and seq > self._seq:
+            frames = seq - self._seq
+        self._seq = seq
+        with tracer.span("fft", "audio"):
+            return self._update(audio_samples, frames)
+
+    def _update(self, audio_samples, frames=1):
+        # Thie was microphone_update() in visualization.py
+        # Quiet audio never gets here; the mic gates silence on the raw blocks
+        # Window and normalise the int16-scaled samples between 0 and 1
+        # into the FFT input; the rest of it stays zero padding up to
+        # the next power of two
+        N = self.window_size
+        np.multiply(audio_samples, self.fft_window, out=self._fft_in[:N])
+        # Transform audio input into the frequency domain
+        if _RFFT_OUT:
+            YS = np.fft.rfft(self._fft_in, out=self._fft_out)[:N // 2]
+        else:
+            YS = np.fft.rfft(self._fft_in)[:N // 2]
+        np.abs(YS, out=self._magnitude)
+        # Apply the Mel filterbank to the FFT data
+        mel = np.matmul(self._magnitude, self._mel_t, out=self._mel)
+        # Scale data to values more suitable for visualization
+        np.square(mel, out=mel)
+        # Gain normalization
+        self.mel_gain.update(np.max(blur(mel, sigma=1.0)))
+        mel /= self.mel_gain.value
+        # Onsets use the unsmoothed mel so they aren't delayed
+        self.rhythm.update(mel, frames)
+        self.mel = self.mel_smoothing.update(mel)
+        return self.mel
+
+
+_analyses = OrderedDict()
+MAX_ANALYSES = 8
+"""Number of distinct analysis configurations kept by analysis_for()"""
+
+
+def analysis_for(**params):
+    """Return the shared Analysis for these parameters, making it if
+    needed. The least recently used ones are dropped beyond
+    MAX_ANALYSES (shows still holding them keep working)."""
+    key = tuple(sorted(params.items()))
+    analysis = _analyses.get(key)
+    if analysis is None:
+        analysis = _analyses[key] = Analysis(**params)
+        while len(_analyses) > MAX_ANALYSES:
+            _analyses.popitem(last=False)
+    else:
+        _analyses.move_to_end(key)
+    return analysis
+
+
 def create_mel_bank():
     global samples, mel_y, mel_x
-    samples = int(config.MIC_RATE * config.N_ROLLING_HISTORY / (2.0 * config.FPS))
+    samples = window_samples() // 2
     mel_y, (_, mel_x) = melbank.compute_melmat(num_mel_bands=config.N_FFT_BINS,
                                                freq_min=config.MIN_FREQUENCY,
                                                freq_max=config.MAX_FREQUENCY,
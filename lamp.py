@@ -1,14 +1,34 @@
 #!/usr/bin/env python3
 import asyncio
 import logging
+import signal
+import time
 import toml
 from sensor2mqtt import MQController
 
+import dsp
+
 from lamp.StripPlayer import StripPlayer
 from rpi_ws281x import PixelStrip
 
 logger = logging.getLogger(__name__)
 
+CONFIG_PATH = "/home/pi/lamp.toml"
+
+LOG_MODULES = ("__main__",
+               "lamp",
+#               "sensor2mqtt",
+               "microphone",
+               "audiosource",
+               "broadcast",
+               "tracing",
+              )
+
+# Settings only read at startup
+RESTART_SETTINGS = ("led_count", "led_pin", "led_freq_hz", "led_dma",
+                    "led_invert", "led_channel", "mqtt_host", "username",
+                    "password")
+
 
 class myFormatter(logging.Formatter):
     def __init__(self, fmt):
@@ -28,27 +48,95 @@ class myFormatter(logging.Formatter):
         return res
 
 
+def log_level(config):
+    if "debug" in config and config["debug"]:
+        return logging.DEBUG
+    return logging.INFO
+
+
+def set_log_level(handler, lvl):
+    handler.setLevel(lvl)
+    for l in LOG_MODULES:
+        logging.getLogger(l).setLevel(lvl)
+
+
+class Reloader:
+    """Re-reads lamp.toml on SIGHUP and applies what changed without
+    tearing down the PixelStrip, the audio stream, MQTT or the shows.
+
+    The debug level, led_brightness and the [strips] substrips are
+    applied live. Audio settings, the settings in RESTART_SETTINGS
+    and the other [strips] settings (clock, quality, recorder_path
+    etc) are only read at startup so changing them logs a warning.
+    """
+
+    def __init__(self, config, strip, strip_player, handler):
+        self.config = config
+        self.strip = strip
+        self.strip_player = strip_player
+        self.handler = handler
+
+    def signalled(self):
+        asyncio.create_task(self.reload())
+
+    async def reload(self):
+        start = time.monotonic()
+        try:
+            config = toml.load(CONFIG_PATH)
+        except (OSError, toml.TomlDecodeError) as e:
+            logger.error("Not reloading, can't read %s: %s", CONFIG_PATH, e)
+            return
+        old = self.config
+        changed = sorted(k for k in set(config) | set(old)
+                         if config.get(k) != old.get(k))
+        logger.info("Reloading %s, changed: %s", CONFIG_PATH, changed)
+        self.config = config
+        if "debug" in changed:
+            set_log_level(self.handler, log_level(config))
+        if "led_brightness" in changed and "led_brightness" in config:
+            await self.strip_player.setBrightness(config["led_brightness"])
+        strips = config.get("strips", {})
+        dark = 0.0
+        if "strips" in changed:
+            dark = await self.strip_player.reconfigure(strips)
+        needs_restart = [k for k in changed
+                         if k in RESTART_SETTINGS or
+                         k in dsp.config.AUDIO_SETTINGS]
+        needs_restart += self.strip_settings_changed(old.get("strips", {}),
+                                                     strips)
+        if needs_restart:
+            logger.warning("Restart to apply %s", needs_restart)
+        logger.info("Reload took %.1fms, substrips dark for %.1fms",
+                    (time.monotonic() - start) * 1000, dark * 1000)
+
+    @staticmethod
+    def strip_settings_changed(old, new):
+        """The [strips] settings, as opposed to substrips, which differ.
+        StripPlayer reads them once when it starts. reconfigure() warns
+        about the name itself."""
+        return sorted(f"strips.{k}" for k in set(old) | set(new)
+                      if k != "name" and
+                      not isinstance(old.get(k), dict) and
+                      not isinstance(new.get(k), dict) and
+                      old.get(k) != new.get(k))
+
+
 async def main():
     #asyncio.get_running_loop().set_exception_handler(handle_exception)
 
-    config = toml.load("/home/pi/lamp.toml")
-    if "debug" in config and config["debug"]:
-        lvl = logging.DEBUG
-    else:
-        lvl = logging.INFO
-    modules = ("__main__",
-               "lamp",
-#               "sensor2mqtt",
-               "microphone",
-              )
+    config = toml.load(CONFIG_PATH)
+    lvl = log_level(config)
 
     ch = logging.StreamHandler()
-    ch.setLevel(lvl)
     ch.setFormatter(myFormatter("%(name)s:(task_id) : %(message)s"))
-    for l in modules:
+    for l in LOG_MODULES:
         logging.getLogger(l).addHandler(ch)
-        logging.getLogger(l).setLevel(lvl)
+    set_log_level(ch, lvl)
     logger.debug("Config file loaded:\n%s", config)
+    if dsp.configure(config):
+        logger.info("Audio analysis: %d Hz, hop %d, window %d samples",
+                    dsp.config.MIC_RATE, dsp.hop_samples(),
+                    dsp.window_samples())
 
     strip = PixelStrip(config["led_count"], config["led_pin"],
                        config["led_freq_hz"], config["led_dma"],
@@ -58,6 +146,9 @@ async def main():
 
     mqtt_controller = MQController(config)
     strip_player = StripPlayer(mqtt_controller, strip, config["strips"])
+    reloader = Reloader(config, strip, strip_player, ch)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP,
+                                                  reloader.signalled)
     await strip_player.run()
 
-asyncio.run(main(), debug=True)
+asyncio.run(main())
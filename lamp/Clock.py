@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import struct
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SharedClock:
+    """A timeline shared by several lamps over MQTT.
+
+    In "master" mode the lamp's own time.time() is the timeline and
+    publish() sends it as a 12 byte reference (time, sequence number)
+    for the peers. In "peer" mode handle() is given each reference as
+    it arrives and the clock estimates the master's offset and drift
+    from the last window of them; time() then returns the master's
+    time. In "local" mode (the default) it is just time.time().
+
+    References are delayed by the network so master time minus local
+    time at arrival is the true offset less the delay. The samples
+    with the least delay are the highest ones so the drift is the
+    slope between the highest samples in the older and newer halves
+    of the window (once it spans MIN_DRIFT_SPAN seconds, before which
+    the delays swamp any drift) and the offset is the highest detrended sample.
+    jitter is how far the median sample sits below that and is a fair
+    bound on the skew between this lamp and the master.
+
+    Until a peer has its first reference it uses local time.
+    """
+    MODES = ("local", "master", "peer")
+    FORMAT = struct.Struct("!dI")
+    MIN_DRIFT_SPAN = 20.0
+
+    def __init__(self, mode="local", window=32, clock=time.monotonic):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown clock mode {mode}")
+        self.mode = mode
+        self.clock = clock
+        self._local = np.zeros(window)
+        self._master = np.zeros(window)
+        self._count = 0
+        self._seq = 0
+        self._local0 = None
+        self.offset = 0.0
+        self.drift = 0.0
+        self.jitter = 0.0
+
+    @property
+    def synced(self):
+        return self.mode == "peer" and self._count > 0
+
+    def time(self):
+        """Seconds on the shared timeline"""
+        if not self.synced:
+            return time.time()
+        local = self.clock()
+        return local + self.offset + self.drift * (local - self._local0)
+
+    def until(self, t):
+        """Local seconds to wait until shared time t"""
+        return (t - self.time()) / (1.0 + self.drift)
+
+    def until_next(self, interval):
+        """Local seconds to wait until the next multiple of interval
+        on the shared timeline, so frames land together on all lamps"""
+        now = self.time()
+        return self.until((now // interval + 1) * interval)
+
+    def reference(self):
+        """A packed reference for peers (master only)"""
+        self._seq += 1
+        return self.FORMAT.pack(time.time(), self._seq)
+
+    def handle(self, payload):
+        """Take a reference from the master (peer only)"""
+        if self.mode != "peer":
+            return
+        try:
+            master, seq = self.FORMAT.unpack(payload)
+        except struct.error:
+            logger.warning("Bad clock reference %r", payload)
+            return
+        local = self.clock()
+        if self._local0 is None:
+            self._local0 = local
+        i = self._count % len(self._local)
+        self._local[i] = local - self._local0
+        self._master[i] = master - local
+        self._count += 1
+        self._estimate()
+        if self._count % 60 == 1:
+            logger.info("Clock offset %.3fs drift %.1fppm jitter %.1fms",
+                        self.offset, self.drift * 1e6, self.jitter * 1000)
+
+    def _estimate(self):
+        n = min(self._count, len(self._local))
+        x = self._local[:n]
+        y = self._master[:n]
+        if n >= 8 and np.ptp(x) >= self.MIN_DRIFT_SPAN:
+            order = np.argsort(x)
+            old, new = order[:n // 2], order[n // 2:]
+            i = old[np.argmax(y[old])]
+            j = new[np.argmax(y[new])]
+            if x[j] > x[i]:
+                self.drift = (y[j] - y[i]) / (x[j] - x[i])
+        residual = y - self.drift * x
+        self.offset = float(np.max(residual))
+        self.jitter = self.offset - float(np.median(residual))
+
+    async def run(self, publish, topic, interval=1.0):
+        """Publish a reference every interval seconds (master only)"""
+        while True:
+            publish(topic, self.reference())
+            await asyncio.sleep(interval)
+
+
+local_clock = SharedClock()
+"""Clock for shows without a controller clock"""
@@ -0,0 +1,114 @@
+import logging
+import time
+
+import numpy as np
+
+from .SubStrip import led_buffer
+
+logger = logging.getLogger(__name__)
+
+
+class FlightRecorder:
+    """Keeps the last few seconds of frames sent to the strip.
+
+    record() is called each time strip.show() is called and copies the
+    whole LED buffer into a preallocated ring along with the time, the
+    show that produced it, the time since that show's previous frame,
+    the strip brightness and the quality level (set in quality by the
+    StripPlayer's QualityController). Nothing is allocated per frame so it can
+    be left running.
+
+    Every substrip's show records its own frames, so the ring holds
+    seconds * fps frames for each of streams substrips; resize() when
+    the number changes.
+
+    snapshot() returns the ring in time order and dump() writes it to
+    an .npz file for offline analysis.
+    """
+
+    def __init__(self, strip, seconds=10, fps=60, streams=1):
+        self.strip = strip
+        self.seconds = seconds
+        self.fps = fps
+        self.quality = 0
+        self.show_names = []
+        self._show_ids = {}
+        self.count = 0
+        # Slots holding a frame; fewer than count after a resize
+        self._filled = 0
+        self._leds = None
+        self._allocate(self._capacity(streams))
+
+    def _capacity(self, streams):
+        return max(int(self.seconds * self.fps * max(streams, 1)), 1)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        num_pixels = self.strip.numPixels()
+        self.frames = np.zeros((capacity, num_pixels), dtype=np.uint32)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.durations = np.zeros(capacity, dtype=np.float32)
+        self.brightness = np.zeros(capacity, dtype=np.uint8)
+        self.shows = np.zeros(capacity, dtype=np.int16)
+        self.levels = np.zeros(capacity, dtype=np.uint8)
+
+    def resize(self, streams):
+        """Hold seconds of frames for streams substrips, keeping the
+        most recent frames. count carries on from where it was."""
+        capacity = self._capacity(streams)
+        if capacity == self.capacity:
+            return
+        snapshot = self.snapshot()
+        self._allocate(capacity)
+        kept = min(len(snapshot["times"]), capacity)
+        slots = np.arange(self.count - kept, self.count) % capacity
+        for name, array in (("frames", self.frames),
+                            ("times", self.times),
+                            ("durations", self.durations),
+                            ("brightness", self.brightness),
+                            ("shows", self.shows),
+                            ("quality", self.levels)):
+            array[slots] = snapshot[name][len(snapshot[name]) - kept:]
+        self._filled = kept
+
+    def record(self, show, duration=0.0):
+        """Record the frame that has just been shown by show (a name)"""
+        i = self.count % self.capacity
+        if self._leds is None:
+            self._leds = led_buffer(self.strip)
+        if self._leds is not None:
+            np.copyto(self.frames[i], self._leds)
+        else:
+            # No direct access to the buffer so take the slow route
+            self.frames[i] = self.strip.getPixels()
+        self.times[i] = time.time()
+        self.durations[i] = duration
+        self.brightness[i] = self.strip.getBrightness()
+        self.levels[i] = self.quality
+        show_id = self._show_ids.get(show)
+        if show_id is None:
+            show_id = self._show_ids[show] = len(self.show_names)
+            self.show_names.append(show)
+        self.shows[i] = show_id
+        self.count += 1
+        self._filled = min(self._filled + 1, self.capacity)
+
+    def snapshot(self):
+        """Return a dict of copies of the recorded arrays, oldest first"""
+        n = self._filled
+        order = (np.arange(n) + self.count - n) % self.capacity
+        return {
+            "frames": self.frames[order],
+            "times": self.times[order],
+            "durations": self.durations[order],
+            "brightness": self.brightness[order],
+            "shows": self.shows[order],
+            "quality": self.levels[order],
+            "show_names": np.array(self.show_names, dtype=str),
+        }
+
+    @staticmethod
+    def dump(snapshot, path):
+        """Write a snapshot() to path as an .npz file"""
+        np.savez_compressed(path, **snapshot)
+        logger.info("Dumped %d frames to %s", len(snapshot["times"]), path)
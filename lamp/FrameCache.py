@@ -0,0 +1,49 @@
+import logging
+from collections import OrderedDict
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class FrameCache:
+    """Arrays of precomputed frames kept within a memory budget.
+
+    Entries are keyed by whatever identifies the animation, typically
+    (painter, args, number of pixels). When a new entry takes the
+    total over budget the least recently used entries are dropped.
+    Entries bigger than the whole budget are not kept at all.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self._frames = OrderedDict()
+
+    def get(self, key):
+        frames = self._frames.get(key)
+        if frames is not None:
+            self._frames.move_to_end(key)
+        return frames
+
+    def put(self, key, frames):
+        """Store frames and return whether they were kept"""
+        if frames.nbytes > self.budget:
+            return False
+        self.discard(key)
+        self._frames[key] = frames
+        self.size += frames.nbytes
+        while self.size > self.budget:
+            old_key, old = self._frames.popitem(last=False)
+            self.size -= old.nbytes
+            logger.debug("Dropped cached frames for %s", old_key)
+        return True
+
+    def discard(self, key):
+        frames = self._frames.pop(key, None)
+        if frames is not None:
+            self.size -= frames.nbytes
+
+
+frame_cache = FrameCache(config.FRAME_CACHE_BYTES)
+"""The cache shared by all periodic painters"""
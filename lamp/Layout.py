@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class Layout:
+    """Maps a logical frame of size pixels onto num_pixels physical
+    ones. Physical pixel i shows logical pixel index[i] so a logical
+    pixel may be shown several times (eg when mirrored).
+
+    map() is one np.take so a layout costs the same however it was
+    described.
+    """
+
+    def __init__(self, index, size):
+        self.index = np.asarray(index, dtype=np.intp)
+        self.index.flags.writeable = False
+        self.size = size
+        self._positions = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def map(self, frame, out=None):
+        """Map a logical frame (last axis size) onto physical pixels"""
+        # The index is always in range and "clip" lets take() write
+        # straight into out rather than through a buffer
+        return np.take(frame, self.index, axis=-1, out=out, mode="clip")
+
+    def positions(self, p):
+        """The physical pixels showing logical pixel p"""
+        if self._positions is None:
+            order = np.argsort(self.index, kind="stable")
+            bounds = np.searchsorted(self.index[order], np.arange(self.size + 1))
+            self._positions = [order[a:b] for a, b in zip(bounds, bounds[1:])]
+        return self._positions[p]
+
+
+def _mirror(n):
+    # Logical pixel 0 is in the centre and the frame spreads out to
+    # both ends; with an odd n the centre pixel is shown once
+    size = (n + 1) // 2
+    return np.concatenate((np.arange(size)[::-1],
+                           np.arange(n % 2, size))), size
+
+
+def _matrix(n, width, height, serpentine=True):
+    # The logical frame is row after row of width pixels. Every other
+    # row is wired back the other way in a serpentine matrix.
+    if width * height != n:
+        raise ValueError(f"A {width}x{height} matrix isn't {n} pixels")
+    index = np.arange(n).reshape(height, width)
+    if serpentine:
+        index[1::2] = index[1::2, ::-1]
+    return index.ravel(), n
+
+
+def _segments(n, segments):
+    # Each segment is [logical_first, count] or
+    # [logical_first, count, true] for reversed, laid along the
+    # physical pixels in turn
+    parts = []
+    for segment in segments:
+        if not 2 <= len(segment) <= 3:
+            raise ValueError(f"Bad segment {segment}")
+        first, count = int(segment[0]), int(segment[1])
+        if first < 0 or count < 1:
+            raise ValueError(f"Bad segment {segment}")
+        part = np.arange(first, first + count)
+        if len(segment) == 3 and segment[2]:
+            part = part[::-1]
+        parts.append(part)
+    index = np.concatenate(parts) if parts else np.zeros(0, dtype=np.intp)
+    if len(index) != n:
+        raise ValueError(f"Segments cover {len(index)} pixels, not {n}")
+    return index, int(index.max()) + 1
+
+
+def compile_layout(layout, num_pixels):
+    """Compile a layout description for num_pixels physical pixels
+    into a Layout, or None for the plain "linear" layout. Raises
+    ValueError for a bad description. Descriptions (as in lamp.toml):
+      "linear"
+      "reverse"
+      "mirror"                        logical 0 in the centre
+      {matrix = [w, h], serpentine = true}
+      {segments = [[first, count], [first, count, true], ...]}
+    """
+    n = num_pixels
+    if layout is None or layout == "linear":
+        return None
+    if layout == "reverse":
+        return Layout(np.arange(n)[::-1], n)
+    if layout == "mirror":
+        return Layout(*_mirror(n))
+    if isinstance(layout, dict):
+        try:
+            if "matrix" in layout:
+                width, height = layout["matrix"]
+                return Layout(*_matrix(n, int(width), int(height),
+                                       layout.get("serpentine", True)))
+            if "segments" in layout:
+                return Layout(*_segments(n, layout["segments"]))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Bad layout {layout}: {e}") from None
+    raise ValueError(f"Unknown layout {layout}")
@@ -5,125 +5,246 @@ import time
 
 import dsp
 import numpy as np
-from scipy.ndimage.filters import gaussian_filter1d
-from microphone import Microphone
+import audiosource
+from audiosource import AudioSource
 from .StripShow import StripShow
+from .Particles import Particles
+from .Pipeline import Pipeline, rgb_to_frame
+from .Layout import compile_layout
 
 import config
 
 logger = logging.getLogger(__name__)
 
 ################################################################
-# Helper functions
-def memoize(function):
-    """Provides a decorator for memoizing functions"""
-    from functools import wraps
-    memo = {}
-
-    @wraps(function)
-    def wrapper(*args):
-        if args in memo:
-            return memo[args]
-        else:
-            rv = function(*args)
-            memo[args] = rv
-            return rv
-    return wrapper
-
-
-@memoize
-def _normalized_linspace(size):
-    return np.linspace(0, 1, size)
-
-
-def interpolate(y, new_length):
-    """Intelligently resizes the array by linearly interpolating the values
-
-    Parameters
-    ----------
-    y : np.array
-        Array that should be resized
+# Painter Super Class for Music
+class MusicShow(StripShow):
+    # Use a class instance of the AudioSource (config.AUDIO_SOURCE,
+    # normally the Microphone). This is instantiated by the first
+    # class.  An alternate strategy is to set the MusicShow.mic as
+    # part of setting up the StripController
+    mic = None
 
-    new_length : int
-        The length of the new interpolated array
+    ARGS = {"fps": ("number", 1, None),
+            "idle_decay": ("number", 0, 1),
+            "bins": ("int", 1, None),
+            "min_frequency": ("number", 0, None),
+            "max_frequency": ("number", 0, None),
+            "smoothing": ("rates", 2)}
 
-    Returns
-    -------
-    z : np.array
-        New array with length of new_length that contains the interpolated
-        values of y.
+    N_FFT_BINS = None
+    """Default number of mel bands for the show (None means
+    config.N_FFT_BINS); painter args can override it with "bins".
     """
-    if len(y) == new_length:
-        return y
-    x_old = _normalized_linspace(len(y))
-    x_new = _normalized_linspace(new_length)
-    z = np.interp(x_new, x_old, y)
-    return z
-
 
-################################################################
-# Painter Super Class for Music
-class MusicShow(StripShow):
-    # Use a class instance of the Microphone This is instantiated by
-    # the first class.  An alternate strategy is to set the
-    # MusicShow.mic as part of setting up the StripController
-    mic = None
+    QUALITY = ("bins", "fps")
+    """The steps of Quality.LADDER this show can take when the lamp
+    is short of CPU"""
 
     def __init__(self, controller, args):
         super().__init__(controller, args)
 
-        # Number of audio samples to read every time frame
-        self.samples_per_frame = int(config.MIC_RATE / config.FPS)
-        # Array containing the rolling audio sample window
-        self.y_roll = np.random.rand(
-            config.N_ROLLING_HISTORY, self.samples_per_frame) / 1e16
-        self.fft_window = np.hamming(int(config.MIC_RATE / config.FPS) *
-                                     config.N_ROLLING_HISTORY)
-        self.mel_gain = dsp.ExpFilter(np.tile(1e-1, config.N_FFT_BINS),
-                                      alpha_decay=0.01, alpha_rise=0.99)
-        self.mel_smoothing = dsp.ExpFilter(np.tile(1e-1, config.N_FFT_BINS),
-                                           alpha_decay=0.5, alpha_rise=0.99)
-        if not MusicShow.mic:
-            MusicShow.mic = Microphone(config.MIC_RATE, config.FPS)
-        self.mic = MusicShow.mic
-        logger.debug("Made %s", self.mic)
-
-    def to_mel(self, audio_samples):
-        # Thie was microphone_update() in visualization.py
-        # Normalize samples between 0 and 1
-        y = audio_samples / 2.0**15
-        # Construct a rolling window of audio samples
-        self.y_roll[:-1] = self.y_roll[1:]
-        self.y_roll[-1, :] = np.copy(y)
-        y_data = np.concatenate(self.y_roll, axis=0).astype(np.float32)
-
-        vol = np.max(np.abs(y_data))
-        if vol < 0:  # config.MIN_VOLUME_THRESHOLD:
-            # print('No audio input. Volume below threshold. Volume:', vol)
-            return None
+        # Audio is captured in blocks of hop samples and analysed in
+        # windows of window_size samples; frames are rendered at fps
+        self.hop = dsp.hop_samples()
+        self.window_size = dsp.window_samples()
+        self.fps = args.get("fps", config.FPS)
+        self.frame_interval = 1.0 / self.fps
+        self._next_frame = 0
+        # The last frame painted, kept so it can fade out in silence
+        self._last_pixels = None
+        self.idle_decay = args.get("idle_decay", 0.7)
+        self.mic = self.shared_source()
+        # Analysis parameters may be set in the painter args. Shows
+        # with equal settings share one analysis. A remote source has
+        # already been analysed by its Broadcaster.
+        self.n_bins = args.get("bins", self.N_FFT_BINS or config.N_FFT_BINS)
+        if hasattr(self.mic, "analysis_for"):
+            self.analysis = self.mic.analysis_for(self.n_bins)
         else:
-            # Transform audio input into the frequency domain
-            N = len(y_data)
-            N_zeros = 2**int(np.ceil(np.log2(N))) - N
-            # Pad with zeros until the next power of two
-            y_data *= self.fft_window
-            y_padded = np.pad(y_data, (0, N_zeros), mode='constant')
-            YS = np.abs(np.fft.rfft(y_padded)[:N // 2])
-            # Construct a Mel filterbank from the FFT data
-            mel = np.atleast_2d(YS).T * dsp.mel_y.T
-            # Scale data to values more suitable for visualization
-            # mel = np.sum(mel, axis=0)
-            mel = np.sum(mel, axis=0)
-            mel = mel**2.0
-            # Gain normalization
-            self.mel_gain.update(np.max(gaussian_filter1d(mel, sigma=1.0)))
-            mel /= self.mel_gain.value
-            mel = self.mel_smoothing.update(mel)
-            return mel
-            # # Map filterbank output onto LED strip
-            # output = self.visualization_effect(mel)
-            # self.pixels = output
-            # return self.update()
+            self.analysis = self.make_analysis(args, self.n_bins)
+        self._low_analysis = None
+        # The show's dsp.GaussianBlur and the (sigma, shape) it is for
+        self._blur = None
+        self._blur_key = None
+        # The controller's QualityController, if it has one
+        self.qos = getattr(controller, "quality", None)
+        logger.debug("Made %s", self.mic)
+        total, parts = dsp.latency(self.fps)
+        logger.info("%s audio to light latency ~%.1fms "
+                    "(capture %.1fms, window %.1fms, render %.1fms)",
+                    self.__class__.__name__, total * 1000,
+                    parts["capture"] * 1000, parts["window"] * 1000,
+                    parts["render"] * 1000)
+
+    @staticmethod
+    def shared_source():
+        """The AudioSource (config.AUDIO_SOURCE) shared by all music
+        shows and any Broadcaster, made on first use"""
+        if not MusicShow.mic:
+            hop = dsp.hop_samples()
+            hold = int(np.ceil(config.SILENCE_HOLD * config.MIC_RATE / hop))
+            gate = dsp.SilenceGate(config.SILENCE_RMS, config.SOUND_RMS, hold)
+            MusicShow.mic = audiosource.create_source(
+                config.AUDIO_SOURCE, config.MIC_RATE, hop,
+                history=dsp.window_samples(), linger=config.MIC_LINGER,
+                gate=gate)
+        return MusicShow.mic
+
+    @staticmethod
+    def make_analysis(args, n_bins):
+        """The shared dsp.Analysis for a show's args. Shows analysing
+        the same blocks into the same bins share it whatever their
+        fps."""
+        return dsp.analysis_for(
+            n_bins=n_bins,
+            freq_min=args.get("min_frequency", config.MIN_FREQUENCY),
+            freq_max=args.get("max_frequency", config.MAX_FREQUENCY),
+            smoothing=tuple(args.get("smoothing", (0.5, 0.99))),
+            window_size=dsp.window_samples(),
+            sample_rate=config.MIC_RATE,
+            hop=dsp.hop_samples())
+
+    @staticmethod
+    def broadcaster(address, fmt="uint8", mqtt_publish=None):
+        """A broadcast.Broadcaster sending the default analysis of
+        the shared source to address"""
+        import broadcast
+        return broadcast.Broadcaster(
+            MusicShow.shared_source(),
+            MusicShow.make_analysis({}, config.N_FFT_BINS),
+            broadcast.create_sender(address, mqtt_publish), fmt)
+
+    async def mel_frames(self):
+        """Async generator used by painters to get a mel spectrum for
+        each new audio block.
+
+        It sleeps until the mic signals a new block so a painter wakes
+        once per block and is idle otherwise. If blocks arrive faster
+        than the render rate the frame waits until it is due and then
+        analyses the latest window.
+
+        None is yielded when there is nothing to analyse because the
+        audio is silent or missing; the strip has already been updated
+        and the painter should just yield.
+        """
+        seq = self.mic.seq
+        while self.running:
+            new = await self.mic.next_block(seq, timeout=0.5)
+            if new is None:
+                await self.no_audio()
+                yield None
+                continue
+            if self.mic.silent:
+                await self.idle()
+                seq = self.mic.seq
+                yield None
+                continue
+            interval = self.frame_interval
+            if self.degraded("fps"):
+                interval *= 2
+            now = time.monotonic()
+            if now < self._next_frame:
+                await asyncio.sleep(self._next_frame - now)
+                now = self._next_frame
+            self._next_frame = max(self._next_frame + interval, now)
+            seq = self.mic.seq
+            yield self.to_mel(self.mic.recent(self.window_size), seq)
+            if self.qos is not None:
+                # The painter and strip.show() have now had the frame
+                self.qos.frame(time.monotonic() - now, interval)
+
+    async def no_audio(self):
+        """Called when no audio block has arrived for a while. If the
+        capture device has failed the strip is blanked and checked
+        only occasionally"""
+        if self.mic.state == AudioSource.FAILED:
+            self.setPixels(np.zeros(self.numPixels, dtype=np.uint32))
+            await asyncio.sleep(1)
+
+    async def idle(self):
+        """Called by painters whilst the mic reports silence. Fades
+        the last frame towards dark at config.IDLE_FPS but returns as
+        soon as a block of sound arrives."""
+        if self._last_pixels is not None:
+            # Not in place: the array may still belong to the painter
+            pixels = self._last_pixels * self.idle_decay
+            if np.max(pixels) < 1.0:
+                self._last_pixels = None
+                self.setPixels(np.zeros(self.numPixels, dtype=np.uint32))
+            else:
+                self.setPixels(self.prepare_for_strip(pixels))
+        deadline = time.monotonic() + 1.0 / config.IDLE_FPS
+        while self.mic.silent and self.running:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or await self.mic.next_block(
+                    self.mic.seq, timeout) is None:
+                break
+        self._next_frame = time.monotonic()
+
+    def prepare_for_strip(self, pixels):
+        self._last_pixels = pixels
+        return super().prepare_for_strip(pixels)
+
+    def degraded(self, step):
+        """True if the show should take step (see Quality.LADDER) to
+        save CPU"""
+        return self.qos is not None and self.qos.applies(step, self.QUALITY)
+
+    @property
+    def active_analysis(self):
+        """The analysis in use; one with half the mel bands when the
+        "bins" step is taken. Remote sources are already analysed."""
+        if self.degraded("bins") and isinstance(self.analysis, dsp.Analysis):
+            if self._low_analysis is None:
+                self._low_analysis = self.make_analysis(
+                    self.args, max(self.n_bins // 2, 1))
+            return self._low_analysis
+        return self.analysis
+
+    def to_mel(self, audio_samples, seq=None):
+        """Convert a window of audio samples (eg from
+        self.mic.recent(self.window_size)) to a mel spectrum. The
+        result is shared with other shows and must not be modified."""
+        analysis = self.active_analysis
+        mel = analysis.update(audio_samples, seq)
+        if analysis is self._low_analysis:
+            mel = dsp.resample(mel, self.n_bins, "linear")
+        return mel
+
+    @property
+    def rhythm(self):
+        """The dsp.OnsetDetector for this show's analysis"""
+        return self.active_analysis.rhythm
+
+    def blur(self, data, sigma, out=None):
+        """Gaussian blur unless the "blur" step is taken. The show keeps
+        a dsp.GaussianBlur for the last sigma and shape so blurring
+        each frame allocates nothing."""
+        if not self.degraded("blur"):
+            key = (sigma, data.shape)
+            if key != self._blur_key:
+                self._blur = dsp.GaussianBlur(sigma, data.shape)
+                self._blur_key = key
+            return self._blur(data, out=out)
+        if out is None:
+            return data
+        if out is not data:
+            out[...] = data
+        return out
+
+    def render_width(self, n):
+        """How many of n pixels to render; half when the "resolution"
+        step is taken (upscale() them back to n)"""
+        return (n + 1) // 2 if self.degraded("resolution") else n
+
+    @staticmethod
+    def upscale(pixels, n):
+        """Stretch the last axis of pixels to n by repeating pixels"""
+        width = pixels.shape[-1]
+        if width == n:
+            return pixels
+        return np.take(pixels, np.arange(n) * width // n, axis=-1)
 
     async def showHasFinished(self):
         logger.debug("Releasing mic %s client %s", self.mic, self)
@@ -151,73 +272,75 @@ class MusicScroll(MusicShow):
     There is no point using more bins than there are pixels on the LED strip.
 
     """
+    QUALITY = ("bins", "blur", "fps")
+
     async def paint(self):
-        pixels = np.tile(1.0, (3, self.numPixels // 2))
-        logger.debug(f"Frame init {self.numPixels} {pixels} ")
-        gain = dsp.ExpFilter(np.tile(0.01, config.N_FFT_BINS),
-                             alpha_decay=0.001, alpha_rise=0.99)
+        # Paint half the strip from the centre out
+        self.layout = compile_layout("mirror", self.numPixels)
+        pixels = np.tile(1.0, (3, self.layout.size))
+        logger.debug("Frame init %d %s", self.numPixels, pixels)
+        gain = dsp.ExpFilterBank(np.tile(0.01, self.n_bins),
+                                 alpha_decay=0.001, alpha_rise=0.99)
         await self.mic.subscribe_stream(self)
-        while self.running:
-            y = self.mic.audiodata
+        async for y in self.mel_frames():
             if y is None:
-                await asyncio.sleep(0.1)
                 yield True
                 continue
-            y = self.to_mel(y)
             y = y**2.0
             gain.update(y)
             y /= gain.value
             y *= 255.0
-            b = int(np.max(y[:len(y) // 3]))
-            r = int(np.max(y[len(y) // 3: 2 * len(y) // 3]))
-            g = int(np.max(y[2 * len(y) // 3:]))
+            b, r, g = dsp.band_max(y, 3).astype(int)
             # Scrolling effect window
             pixels[:, 1:] = pixels[:, :-1]
             pixels *= 0.98
-            pixels = gaussian_filter1d(pixels, sigma=0.3)
+            self.blur(pixels, sigma=0.3, out=pixels)
             await asyncio.sleep(0)
             # Create new color originating at the center
             pixels[0, 0] = r
             pixels[1, 0] = g
             pixels[2, 0] = b
             # Update the LED strip
-            mirrored_pixels = np.concatenate((pixels[:, ::-1], pixels), axis=1)
-            p = self.prepare_for_strip(mirrored_pixels)
-            self.setPixelColor(slice(0, len(p)), p)
+            p = self.prepare_for_strip(pixels)
+            self.setPixels(p)
             yield True
-            await asyncio.sleep(0)
         logger.debug("%s: paint has finished", self.__class__.__name__)
 
 
 class MusicEnergy(MusicShow):
     """Effect that expands from the center with increasing sound energy"""
 
+    QUALITY = ("bins", "blur", "smoothing", "resolution", "fps")
+
     async def paint(self):
-        pixels = np.tile(1.0, (3, self.numPixels // 2))
-        logger.debug(f"Frame init {self.numPixels} {pixels} ")
-        gain = dsp.ExpFilter(np.tile(0.01, config.N_FFT_BINS),
-                             alpha_decay=0.001, alpha_rise=0.99)
-        p_filt = dsp.ExpFilter(np.tile(1, (3, self.numPixels // 2)),
-                               alpha_decay=0.1, alpha_rise=0.99)
+        self.layout = compile_layout("mirror", self.numPixels)
+        half = self.layout.size
+        width = self.render_width(half)
+        pixels = np.tile(1.0, (3, width))
+        logger.debug("Frame init %d %s", self.numPixels, pixels)
+        gain = dsp.ExpFilterBank(np.tile(0.01, self.n_bins),
+                                 alpha_decay=0.001, alpha_rise=0.99)
+        p_filt = dsp.ExpFilterBank(np.tile(1, (3, width)),
+                                   alpha_decay=0.1, alpha_rise=0.99)
 
         await self.mic.subscribe_stream(self)
-        while self.running:
-            y = self.mic.audiodata
+        async for y in self.mel_frames():
             if y is None:
-                await asyncio.sleep(0.1)
                 yield True
                 continue
-            y = self.to_mel(y)
+            if self.render_width(half) != width:
+                width = self.render_width(half)
+                pixels = np.tile(1.0, (3, width))
+                p_filt = dsp.ExpFilterBank(np.tile(1, (3, width)),
+                                           alpha_decay=0.1, alpha_rise=0.99)
             y = np.copy(y)
             gain.update(y)
             y /= gain.value
             # Scale by the width of the LED strip
-            y *= float((self.numPixels // 2) - 1)*2
+            y *= float(width - 1)*2
             # Map color channels according to energy in the different freq bands
             scale = 0.9
-            r = int(np.mean(y[:len(y) // 3]**scale))
-            g = int(np.mean(y[len(y) // 3: 2 * len(y) // 3]**scale))
-            b = int(np.mean(y[2 * len(y) // 3:]**scale))
+            r, g, b = dsp.band_mean(y**scale, 3).astype(int)
             # Assign color to different frequency regions
             pixels[0, :g] = 255.0
             pixels[0, g:] = 0.0
@@ -226,59 +349,151 @@ class MusicEnergy(MusicShow):
             pixels[2, :b] = 255.0
             pixels[2, b:] = 0.0
             await asyncio.sleep(0)
-            p_filt.update(pixels)
-            pixels = np.round(p_filt.value)
+            if not self.degraded("smoothing"):
+                p_filt.update(pixels)
+                np.round(p_filt.value, out=pixels)
             # Apply substantial blur to smooth the edges
-            pixels[0, :] = gaussian_filter1d(pixels[0, :], sigma=4.0)
-            pixels[1, :] = gaussian_filter1d(pixels[1, :], sigma=4.0)
-            pixels[2, :] = gaussian_filter1d(pixels[2, :], sigma=4.0)
+            self.blur(pixels, sigma=4.0 * width / half, out=pixels)
             # Set the new pixel value
             # Update the LED strip
-            mirrored_pixels = np.concatenate((pixels[:, ::-1], pixels), axis=1)
-            p = self.prepare_for_strip(mirrored_pixels)
-            self.setPixelColor(slice(0, len(p)), p)
+            p = self.prepare_for_strip(self.upscale(pixels, half))
+            self.setPixels(p)
             yield True
-            await asyncio.sleep(0)
         logger.debug("%s: paint has finished", self.__class__.__name__)
 
 class MusicSpectrum(MusicShow):
-    """Effect that maps the Mel filterbank frequencies onto the LED strip"""
+    """Effect that maps the Mel filterbank frequencies onto the LED strip
+
+    The "mapping" arg picks how the bins are spread over the pixels:
+    "linear" (default), "log" or "area" (see dsp.resample_matrix)
+    """
+
+    ARGS = {**MusicShow.ARGS,
+            "mapping": ("choice",) + dsp.RESAMPLE_MODES}
+
+    QUALITY = ("bins", "smoothing", "resolution", "fps")
 
     async def paint(self):
-        pixels = np.tile(1.0, (3, self.numPixels // 2))
-        logger.debug(f"Frame init {self.numPixels} {pixels} ")
-        common_mode = dsp.ExpFilter(np.tile(0.01, self.numPixels // 2),
-                                    alpha_decay=0.99, alpha_rise=0.01)
-        _prev_spectrum = np.tile(0.01, self.numPixels // 2)
-        r_filt = dsp.ExpFilter(np.tile(0.01, self.numPixels // 2),
-                               alpha_decay=0.2, alpha_rise=0.99)
-        g_filt = dsp.ExpFilter(np.tile(0.01, self.numPixels // 2),
-                               alpha_decay=0.05, alpha_rise=0.3)
-        b_filt = dsp.ExpFilter(np.tile(0.01, self.numPixels // 2),
-                               alpha_decay=0.1, alpha_rise=0.5)
+        mapping = self.args.get("mapping", "linear")
+        # Symmetric output, spectrum from the centre out
+        self.layout = compile_layout("mirror", self.numPixels)
+        half = self.layout.size
+        width = None
+        logger.debug("Frame init %d", self.numPixels)
         await self.mic.subscribe_stream(self)
-        while self.running:
-            y = self.mic.audiodata
+        async for y in self.mel_frames():
             if y is None:
-                await asyncio.sleep(0.1)
                 yield True
                 continue
-            y = self.to_mel(y)
-            y = np.copy(interpolate(y, self.numPixels // 2))
-            common_mode.update(y)
+            if self.render_width(half) != width:
+                width = self.render_width(half)
+                # Row 0 is the common mode and row 1 the blue channel;
+                # both smooth the same spectrum so they share one
+                # filter bank
+                common_b_filt = dsp.ExpFilterBank(
+                    np.tile(0.01, (2, width)),
+                    alpha_decay=[[0.99], [0.1]], alpha_rise=[[0.01], [0.5]])
+                common_mode, blue = common_b_filt.value
+                _prev_spectrum = np.tile(0.01, width)
+                r_filt = dsp.ExpFilterBank(np.tile(0.01, width),
+                                           alpha_decay=0.2, alpha_rise=0.99)
+            y = dsp.resample(y, width, mapping)
+            common_b_filt.update(y)
             diff = y - _prev_spectrum
             _prev_spectrum = np.copy(y)
             # Color channel mappings
-            r = r_filt.update(y - common_mode.value)
+            if self.degraded("smoothing"):
+                r = y - common_mode
+            else:
+                r = r_filt.update(y - common_mode)
             g = np.abs(diff)
-            b = b_filt.update(np.copy(y))
-            # Mirror the color channels for symmetric output
-            r = np.concatenate((r[::-1], r))
-            g = np.concatenate((g[::-1], g))
-            b = np.concatenate((b[::-1], b))
-            pixels = np.array([r, g, b]) * 255
+            pixels = self.upscale(np.array([r, g, blue]), half) * 255
             p = self.prepare_for_strip(pixels)
-            self.setPixelColor(slice(0, len(p)), p)
+            self.setPixels(p)
+            yield True
+        logger.debug("%s: paint has finished", self.__class__.__name__)
+
+
+class MusicBurst(MusicShow):
+    """Bursts of particles thrown out from a random point on each
+    onset, sized by its strength and coloured by where the energy is
+    in the spectrum. Args (besides the MusicShow ones):
+    particles : most particles in one burst (default 60)
+    speed     : fastest particle speed in pixels per second (default 80)
+    lifetime  : seconds each particle lasts (default 1.0)
+    tail      : fraction of brightness kept per frame (default 0.6)
+    seed      : seed for the random numbers
+    """
+
+    ARGS = {**MusicShow.ARGS,
+            "particles": ("int", 1, None),
+            "speed": ("number", 0, None),
+            "lifetime": "positive",
+            "tail": ("number", 0, 1),
+            "seed": ("int", 0, None)}
+
+    async def paint(self):
+        size = self.args.get("particles", 60)
+        speed = self.args.get("speed", 80)
+        lifetime = self.args.get("lifetime", 1.0)
+        tail = self.args.get("tail", 0.6)
+        capacity = max(int(size * lifetime * self.fps / 4), size)
+        burst = Particles(capacity, self.numPixels,
+                          seed=self.args.get("seed"))
+        rng = burst.rng
+        strength = dsp.ExpFilter(0.01, alpha_decay=0.01, alpha_rise=0.5)
+        last = time.monotonic()
+        await self.mic.subscribe_stream(self)
+        async for y in self.mel_frames():
+            if y is None:
+                burst.clear()
+                last = time.monotonic()
+                yield True
+                continue
+            now = time.monotonic()
+            burst.update(now - last)
+            last = now
+            rhythm = self.rhythm
+            strength.update(rhythm.strength)
+            if rhythm.onset:
+                n = int(size * min(rhythm.strength / strength.value, 2.0) / 2)
+                # Low, mid and high bands drive red, green and blue
+                colour = rgb_to_frame(dsp.band_mean(y, 3))
+                colour = colour / max(np.max(colour), 1e-6) * 255
+                colour = colour[:, None] * rng.uniform(0.5, 1.0, n)
+                burst.spawn(n, rng.uniform(0, self.numPixels),
+                            velocity=rng.uniform(-speed, speed, n),
+                            colour=colour,
+                            lifetime=lifetime * rng.uniform(0.5, 1.0, n))
+            # Fade out over each particle's life
+            pixels = burst.render(1.0 - burst.phase(), fade=tail)
+            self.setPixels(self.prepare_for_strip(pixels))
+            yield True
+        logger.debug("%s: paint has finished", self.__class__.__name__)
+
+
+class MusicEffect(MusicShow):
+    """Effect for music: runs the Pipeline in "stages" once per
+    analysed audio frame with the mel spectrum available to "mel"
+    stages"""
+
+    ARGS = {**MusicShow.ARGS, "stages": "list"}
+
+    def __init__(self, controller, args):
+        super().__init__(controller, args)
+        self.pipeline = Pipeline(args.get("stages"))
+
+    async def paint(self):
+        pipeline = self.pipeline.setup(self.numPixels)
+        start = last = time.monotonic()
+        await self.mic.subscribe_stream(self)
+        async for y in self.mel_frames():
+            if y is None:
+                yield True
+                continue
+            now = time.monotonic()
+            pixels = pipeline.run(now - start, now - last, y)
+            last = now
+            self.setPixels(self.prepare_for_strip(pixels))
             yield True
-            await asyncio.sleep(0)
         logger.debug("%s: paint has finished", self.__class__.__name__)
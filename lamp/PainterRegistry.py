@@ -0,0 +1,231 @@
+import importlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = "lamp.painters"
+"""Entry point group other packages can use to add painters, eg in
+setup.cfg:
+[options.entry_points]
+lamp.painters =
+    Fire = mypainters.fire:Fire
+"""
+
+BUILTIN_PAINTERS = {
+    "RainbowFade": "lamp.StripShow:RainbowFade",
+    "SolidColour": "lamp.StripShow:SolidColour",
+    "SolidColourWipe": "lamp.StripShow:SolidColourWipe",
+    "TheaterChase": "lamp.StripShow:TheaterChase",
+    "TheaterChaseRainbow": "lamp.StripShow:TheaterChaseRainbow",
+    "RainbowChase": "lamp.StripShow:RainbowChase",
+    "Sparkle": "lamp.StripShow:Sparkle",
+    "Comets": "lamp.StripShow:Comets",
+    "Effect": "lamp.StripShow:Effect",
+    "PixelStream": "lamp.PixelStream:PixelStream",
+    "MusicScroll": "lamp.MusicShow:MusicScroll",
+    "MusicEnergy": "lamp.MusicShow:MusicEnergy",
+    "MusicSpectrum": "lamp.MusicShow:MusicSpectrum",
+    "MusicBurst": "lamp.MusicShow:MusicBurst",
+    "MusicEffect": "lamp.MusicShow:MusicEffect",
+}
+
+
+################################################################
+# Argument schemas
+#
+# A painter class describes its args in an ARGS dict of arg name to
+# kind. A kind is one of the strings below or a tuple of a kind and
+# its parameters:
+#   "bool", "list", "str", "any"
+#   "int" / ("int", min, max)         (None for no limit)
+#   "number" / ("number", min, max)   int or float
+#   "positive" / ("positive", max)    a number above 0
+#   "colour" / ("colour", "random")   [r, g, b] or the given words
+#   ("rates", n)                      list of n numbers in (0, 1)
+#   ("choice", value, ...)
+def _number(integer, lo=None, hi=None):
+    types = int if integer else (int, float)
+    what = "an integer" if integer else "a number"
+
+    def check(value):
+        if isinstance(value, bool) or not isinstance(value, types):
+            raise ValueError(f"{value!r} is not {what}")
+        if lo is not None and value < lo:
+            raise ValueError(f"{value} is below {lo}")
+        if hi is not None and value > hi:
+            raise ValueError(f"{value} is above {hi}")
+    return check
+
+
+def _positive(hi=None):
+    number = _number(False, None, hi)
+
+    def check(value):
+        number(value)
+        if value <= 0:
+            raise ValueError(f"{value} is not above 0")
+    return check
+
+
+def _colour(*words):
+    def check(value):
+        if value in words:
+            return
+        if (not isinstance(value, (list, tuple)) or len(value) != 3 or
+                not all(isinstance(c, int) and not isinstance(c, bool) and
+                        0 <= c <= 255 for c in value)):
+            raise ValueError(f"{value!r} is not an [r, g, b] colour")
+    return check
+
+
+def _rates(count):
+    # Smoothing factors, which must be strictly between 0 and 1
+    def check(value):
+        if (not isinstance(value, list) or len(value) != count or
+                not all(isinstance(v, (int, float)) and
+                        not isinstance(v, bool) and 0 < v < 1
+                        for v in value)):
+            raise ValueError(f"{value!r} is not a list of {count} numbers "
+                             f"between 0 and 1")
+    return check
+
+
+def _choice(*choices):
+    def check(value):
+        if value not in choices:
+            raise ValueError(f"{value!r} is not one of {choices}")
+    return check
+
+
+def _type(types, what):
+    def check(value):
+        if not isinstance(value, types):
+            raise ValueError(f"{value!r} is not {what}")
+    return check
+
+
+KINDS = {
+    "bool": lambda: _type(bool, "true or false"),
+    "list": lambda: _type(list, "a list"),
+    "str": lambda: _type(str, "a string"),
+    "any": lambda: (lambda value: None),
+    "int": lambda *limits: _number(True, *limits),
+    "number": lambda *limits: _number(False, *limits),
+    "positive": _positive,
+    "colour": _colour,
+    "rates": _rates,
+    "choice": _choice,
+}
+
+
+def compile_schema(args):
+    """Turn an ARGS dict into a dict of arg name to check function"""
+    schema = {}
+    for name, kind in args.items():
+        if isinstance(kind, str):
+            kind = (kind,)
+        try:
+            schema[name] = KINDS[kind[0]](*kind[1:])
+        except (KeyError, TypeError):
+            raise ValueError(f"Bad schema for {name}: {kind}")
+    return schema
+
+
+def validate(schema, args):
+    """Check args against a compiled schema, raising ValueError.
+    Unknown args are ignored (with a warning) as retained state may
+    hold args from older versions."""
+    for name, value in args.items():
+        if name == "name":
+            continue
+        check = schema.get(name)
+        if check is None:
+            logger.warning("Ignoring unknown arg %s=%r for %s",
+                           name, value, args.get("name"))
+            continue
+        try:
+            check(value)
+        except ValueError as e:
+            raise ValueError(f"{args.get('name')} {name}: {e}") from None
+
+
+################################################################
+class PainterRegistry:
+    """Maps painter names (the "name" in a painter's JSON) to classes.
+
+    Painters are registered as "module:Class" strings so nothing is
+    imported until a painter is first asked for. The built in painters
+    are always present and other packages can add more through the
+    lamp.painters entry point group. Only registered names can be
+    created, whatever else is in the painter modules.
+
+    The first time a painter is created its class is imported and its
+    ARGS schema compiled. create() checks the args against it before
+    making the show.
+    """
+
+    def __init__(self, painters=BUILTIN_PAINTERS, entry_points=True):
+        self._targets = dict(painters)
+        self._loaded = {}
+        self._entry_points = entry_points
+
+    def register(self, name, target):
+        """Register a painter as a "module:Class" string or a class"""
+        self._targets[name] = target
+        self._loaded.pop(name, None)
+
+    def _load_entry_points(self):
+        if not self._entry_points:
+            return
+        self._entry_points = False
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            return
+        eps = entry_points()
+        if hasattr(eps, "select"):
+            eps = eps.select(group=ENTRY_POINT_GROUP)
+        else:
+            eps = eps.get(ENTRY_POINT_GROUP, [])
+        for ep in eps:
+            if ep.name in self._targets:
+                logger.warning("Painter %s from %s is already registered",
+                               ep.name, ep.value)
+                continue
+            self._targets[ep.name] = ep.value
+
+    def names(self):
+        self._load_entry_points()
+        return sorted(self._targets)
+
+    def load(self, name):
+        """Return (class, compiled schema) for name, importing it if
+        needed. Raises KeyError if there is no such painter."""
+        loaded = self._loaded.get(name)
+        if loaded is not None:
+            return loaded
+        self._load_entry_points()
+        target = self._targets[name]
+        if isinstance(target, str):
+            module, _, attr = target.partition(":")
+            logger.debug("Loading painter %s from %s", name, target)
+            try:
+                cls = getattr(importlib.import_module(module), attr)
+            except AttributeError as e:
+                raise ImportError(f"{target}: {e}") from None
+        else:
+            cls = target
+        loaded = self._loaded[name] = (cls,
+                                       compile_schema(getattr(cls, "ARGS", {})))
+        return loaded
+
+    def create(self, name, controller, args):
+        """Check args and make the show. Raises KeyError for an unknown
+        painter and ValueError for bad args"""
+        cls, schema = self.load(name)
+        validate(schema, args)
+        return cls(controller, args)
+
+
+registry = PainterRegistry()
+"""The registry StripPlayer uses"""
@@ -0,0 +1,113 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class Particles:
+    """A fixed capacity particle system for painters.
+
+    Particles are stored as parallel arrays (structure of arrays) so
+    spawning, moving, expiring and drawing them are all done with a
+    handful of numpy operations however many there are:
+
+    position : float position along the strip in pixels
+    velocity : pixels per unit of time passed to update()
+    colour   : (3, capacity) colour at full intensity, 0-255
+    age      : time since the particle was spawned
+    lifetime : age at which the particle expires
+    alive    : which slots are in use
+
+    Time is whatever the painter passes to update(); seconds or frames
+    both work as long as velocity and lifetime use the same unit.
+
+    When the system is full further spawns are dropped. The rng is a
+    seeded numpy Generator for painters to use so a show can be
+    replayed exactly.
+    """
+
+    def __init__(self, capacity, num_pixels, seed=None):
+        self.capacity = capacity
+        self.num_pixels = num_pixels
+        self.rng = np.random.default_rng(seed)
+        self.position = np.zeros(capacity)
+        self.velocity = np.zeros(capacity)
+        self.colour = np.zeros((3, capacity))
+        self.age = np.zeros(capacity)
+        self.lifetime = np.ones(capacity)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.frame = np.zeros((3, num_pixels))
+        """The (3, num_pixels) frame render() draws into"""
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+    def spawn(self, n, position, velocity=0.0, colour=255.0, lifetime=1.0):
+        """Spawn up to n particles and return how many were spawned.
+
+        Each attribute may be a scalar or an array of n values; colour
+        is a scalar, an (r, g, b) triple or a (3, n) array.
+        """
+        free = np.flatnonzero(~self.alive)[:n]
+        k = len(free)
+        if k == 0:
+            return 0
+        self.position[free] = np.broadcast_to(position, (n,))[:k]
+        self.velocity[free] = np.broadcast_to(velocity, (n,))[:k]
+        self.lifetime[free] = np.broadcast_to(lifetime, (n,))[:k]
+        colour = np.asarray(colour, dtype=float)
+        if colour.ndim == 1:
+            colour = colour[:, None]
+        self.colour[:, free] = np.broadcast_to(colour, (3, n))[:, :k]
+        self.age[free] = 0.0
+        self.alive[free] = True
+        return k
+
+    def update(self, dt):
+        """Age and move the particles by dt and expire those that are
+        too old or have left the strip"""
+        alive = self.alive
+        self.age[alive] += dt
+        self.position[alive] += self.velocity[alive] * dt
+        alive &= self.age < self.lifetime
+        alive &= self.position > -1.0
+        alive &= self.position < self.num_pixels
+
+    def phase(self):
+        """age / lifetime of every slot, 0.0 -> 1.0 for live particles"""
+        return self.age / self.lifetime
+
+    def render(self, intensity=1.0, fade=0.0):
+        """Draw the live particles into self.frame and return it.
+
+        The existing frame is multiplied by fade first, so 0.0 clears
+        it and values close to 1.0 leave trails. intensity scales each
+        particle (a scalar or an array over all capacity slots, eg
+        from phase()). Particles between pixels are split across the
+        two by distance and overlapping particles add up.
+        """
+        self.frame *= fade
+        idx = np.flatnonzero(self.alive)
+        if len(idx) == 0:
+            return self.frame
+        pos = self.position[idx]
+        left = np.floor(pos)
+        frac = pos - left
+        left = left.astype(int)
+        scale = np.broadcast_to(intensity, (self.capacity,))[idx]
+        w_left = (1.0 - frac) * scale
+        w_right = frac * scale
+        # Shift by one so a particle at -0.5 still lights pixel 0
+        cells = np.concatenate((left + 1, left + 2))
+        n = self.num_pixels + 2
+        for c in range(3):
+            colour = self.colour[c, idx]
+            weights = np.concatenate((colour * w_left, colour * w_right))
+            self.frame[c] += np.bincount(cells, weights, minlength=n)[1:-1]
+        return self.frame
+
+    def clear(self):
+        """Remove all particles and blank the frame"""
+        self.alive[:] = False
+        self.frame[:] = 0.0
@@ -0,0 +1,358 @@
+import logging
+
+import numpy as np
+
+import dsp
+
+logger = logging.getLogger(__name__)
+
+FRAME_CHANNELS = (1, 0, 2)
+"""Frames hold green, red and blue in rows 0, 1 and 2 (the order
+StripShow.prepare_for_strip() packs them in); these are the indices
+of an [r, g, b] colour in frame row order"""
+
+
+def rgb_to_frame(colour):
+    """An [r, g, b] colour (as Colour() takes it), or an array of them
+    along the last axis, reordered into frame rows"""
+    return np.asarray(colour, dtype=float)[..., FRAME_CHANNELS]
+
+
+class Stage:
+    """A step in a Pipeline.
+
+    Stages are made from the painter JSON when the Pipeline is
+    compiled and setup() is called once the number of pixels is known
+    to allocate any buffers. After that __call__() does the work for
+    each frame using only those buffers.
+
+    Source stages draw into self.layer and then blend it onto the
+    frame using the "blend" (replace, add, multiply or max) and
+    "opacity" params; transforms change the frame in place.
+    """
+    source = False
+    BLENDS = ("replace", "add", "multiply", "max")
+
+    def __init__(self, blend="replace", opacity=1.0):
+        if blend not in self.BLENDS:
+            raise ValueError(f"Unknown blend {blend}")
+        self.blend = blend
+        self.opacity = float(opacity)
+        self.n = 0
+        self.layer = None
+
+    def setup(self, n):
+        self.n = n
+        if self.source:
+            self.layer = np.zeros((3, n))
+
+    def __call__(self, frame, t, dt, mel):
+        self.draw(t, dt, mel)
+        self.blend_onto(frame)
+
+    def draw(self, t, dt, mel):
+        raise NotImplementedError
+
+    def blend_onto(self, frame):
+        layer = self.layer
+        if self.blend == "replace":
+            if self.opacity == 1.0:
+                np.copyto(frame, layer)
+                return
+            layer -= frame
+            layer *= self.opacity
+            frame += layer
+        elif self.blend == "add":
+            if self.opacity != 1.0:
+                layer *= self.opacity
+            frame += layer
+        elif self.blend == "multiply":
+            layer *= self.opacity / 255.0
+            layer += 1.0 - self.opacity
+            frame *= layer
+        else:
+            if self.opacity != 1.0:
+                layer *= self.opacity
+            np.maximum(frame, layer, out=frame)
+
+
+def _colours(colours):
+    colours = np.array(colours, dtype=float)
+    if colours.ndim != 2 or colours.shape[1] != 3 or len(colours) < 1:
+        raise ValueError(f"Colours must be a list of [r, g, b]: {colours}")
+    return rgb_to_frame(colours)
+
+
+def _ramp(colours, n, cyclic):
+    """(3, n) linear ramp through the colour stops, which wraps back
+    to the first colour if cyclic"""
+    if cyclic:
+        colours = np.concatenate((colours, colours[:1]))
+        x = np.arange(n) / n
+    else:
+        x = np.linspace(0, 1, n)
+    stops = np.linspace(0, 1, len(colours))
+    return np.array([np.interp(x, stops, colours[:, c]) for c in range(3)])
+
+
+class Gradient(Stage):
+    """Colour ramp across the strip, scrolled at speed pixels per
+    second. Params: colours, speed, cyclic"""
+    source = True
+
+    def __init__(self, colours=((255, 0, 0), (0, 0, 255)), speed=0.0,
+                 cyclic=True, **kwargs):
+        super().__init__(**kwargs)
+        self.colours = _colours(colours)
+        self.speed = float(speed)
+        self.cyclic = bool(cyclic)
+
+    def setup(self, n):
+        super().setup(n)
+        self.ramp = _ramp(self.colours, n, self.cyclic)
+        self.index = np.arange(n)
+        self.shifted = np.zeros(n, dtype=int)
+        np.copyto(self.layer, self.ramp)
+
+    def draw(self, t, dt, mel):
+        if not self.speed:
+            np.copyto(self.layer, self.ramp)
+            return
+        np.subtract(self.index, int(t * self.speed), out=self.shifted)
+        np.take(self.ramp, self.shifted, axis=1, out=self.layer, mode="wrap")
+
+
+class Palette(Stage):
+    """Cyclic palette repeated scale times along the strip and
+    rotated at speed cycles per second. Params: colours, scale, speed"""
+    source = True
+    SIZE = 256
+
+    def __init__(self, colours=((255, 0, 0), (0, 255, 0), (0, 0, 255)),
+                 scale=1.0, speed=0.1, **kwargs):
+        super().__init__(**kwargs)
+        self.lut = _ramp(_colours(colours), self.SIZE, True)
+        self.scale = float(scale)
+        self.speed = float(speed)
+
+    def setup(self, n):
+        super().setup(n)
+        self.base = np.arange(n) * (self.SIZE * self.scale / n)
+        self.pos = np.zeros(n)
+        self.index = np.zeros(n, dtype=int)
+
+    def draw(self, t, dt, mel):
+        np.add(self.base, (t * self.speed % 1.0) * self.SIZE, out=self.pos)
+        np.copyto(self.index, self.pos, casting="unsafe")
+        np.take(self.lut, self.index, axis=1, out=self.layer, mode="wrap")
+
+
+class Noise(Stage):
+    """Smooth value noise in one colour. scale is the feature size in
+    pixels and speed how many features per second drift past.
+    Params: colour, scale, speed, seed"""
+    source = True
+
+    def __init__(self, colour=(255, 255, 255), scale=8.0, speed=1.0,
+                 seed=None, **kwargs):
+        super().__init__(**kwargs)
+        self.colour = _colours([colour])[0][:, None]
+        self.scale = float(scale)
+        if self.scale <= 0:
+            raise ValueError("Noise scale must be positive")
+        self.speed = float(speed)
+        self.seed = seed
+
+    def setup(self, n):
+        super().setup(n)
+        cells = int(np.ceil(n / self.scale)) + 2
+        self.lattice = np.random.default_rng(self.seed).random(cells)
+        self.base = np.arange(n) / self.scale
+        self.x = np.zeros(n)
+        self.f = np.zeros(n)
+        self.i = np.zeros(n, dtype=int)
+        self.a = np.zeros(n)
+        self.b = np.zeros(n)
+
+    def draw(self, t, dt, mel):
+        x, f, i, a, b = self.x, self.f, self.i, self.a, self.b
+        np.add(self.base, t * self.speed % len(self.lattice), out=x)
+        np.floor(x, out=f)
+        np.copyto(i, f, casting="unsafe")
+        np.subtract(x, f, out=f)
+        np.take(self.lattice, i, out=a, mode="wrap")
+        i += 1
+        np.take(self.lattice, i, out=b, mode="wrap")
+        # Smoothstep between the lattice values
+        b -= a
+        np.multiply(f, f, out=x)
+        f *= -2.0
+        f += 3.0
+        f *= x
+        b *= f
+        a += b
+        np.multiply(self.colour, a, out=self.layer)
+
+
+class MelBands(Stage):
+    """The mel spectrum spread over the strip (see dsp.resample_matrix
+    for the modes) in one colour. Blank without music.
+    Params: colour, mapping, gain"""
+    source = True
+
+    def __init__(self, colour=(255, 255, 255), mapping="linear", gain=1.0,
+                 **kwargs):
+        super().__init__(**kwargs)
+        if mapping not in dsp.RESAMPLE_MODES:
+            raise ValueError(f"Unknown mapping {mapping}")
+        self.colour = _colours([colour])[0][:, None] * float(gain)
+        self.mapping = mapping
+
+    def setup(self, n):
+        super().setup(n)
+        self.level = np.zeros(n)
+
+    def draw(self, t, dt, mel):
+        if mel is None:
+            self.level[:] = 0.0
+        else:
+            dsp.resample(mel, self.n, self.mapping, out=self.level)
+        np.multiply(self.colour, self.level, out=self.layer)
+
+
+class Scroll(Stage):
+    """Moves the frame along at speed pixels per second, wrapping
+    round. Params: speed"""
+
+    def __init__(self, speed=30.0):
+        super().__init__()
+        self.speed = float(speed)
+        self.offset = 0.0
+
+    def setup(self, n):
+        super().setup(n)
+        self.index = np.arange(n)
+        self.shifted = np.zeros(n, dtype=int)
+        self.tmp = np.zeros((3, n))
+
+    def __call__(self, frame, t, dt, mel):
+        self.offset += self.speed * dt
+        shift = int(self.offset)
+        if not shift:
+            return
+        self.offset -= shift
+        np.subtract(self.index, shift, out=self.shifted)
+        np.take(frame, self.shifted, axis=1, out=self.tmp, mode="wrap")
+        np.copyto(frame, self.tmp)
+
+
+class Mirror(Stage):
+    """Reflects the first half of the frame onto the second half, or
+    the second onto the first if reverse. Params: reverse"""
+
+    def __init__(self, reverse=False):
+        super().__init__()
+        self.reverse = bool(reverse)
+
+    def setup(self, n):
+        super().setup(n)
+        half = n // 2
+        index = np.arange(n)
+        if self.reverse:
+            index[:half] = index[::-1][:half]
+        else:
+            index[n - half:] = index[:half][::-1]
+        self.index = index
+        self.tmp = np.zeros((3, n))
+
+    def __call__(self, frame, t, dt, mel):
+        np.take(frame, self.index, axis=1, out=self.tmp)
+        np.copyto(frame, self.tmp)
+
+
+class Blur(Stage):
+    """Gaussian blur along the strip. Params: sigma"""
+
+    def __init__(self, sigma=1.0):
+        super().__init__()
+        self.sigma = float(sigma)
+        if self.sigma <= 0:
+            raise ValueError("Blur sigma must be positive")
+
+    def setup(self, n):
+        super().setup(n)
+        self.blur = dsp.GaussianBlur(self.sigma, (3, n))
+
+    def __call__(self, frame, t, dt, mel):
+        self.blur(frame, out=frame)
+
+
+class Decay(Stage):
+    """Fades the frame so it keeps factor of its brightness each
+    second, leaving trails behind moving sources. Params: factor"""
+
+    def __init__(self, factor=0.1):
+        super().__init__()
+        self.factor = float(factor)
+        if not 0 < self.factor <= 1:
+            raise ValueError("Decay factor must be in (0, 1]")
+
+    def __call__(self, frame, t, dt, mel):
+        frame *= self.factor ** dt
+
+
+STAGES = {
+    "gradient": Gradient,
+    "palette": Palette,
+    "noise": Noise,
+    "mel": MelBands,
+    "scroll": Scroll,
+    "mirror": Mirror,
+    "blur": Blur,
+    "decay": Decay,
+}
+
+
+class Pipeline:
+    """A chain of Stages compiled from a declarative description such
+    as the "stages" list in a painter's JSON:
+
+    [{"op": "palette", "colours": [[255, 0, 0], [0, 0, 255]]},
+     {"op": "mel", "blend": "add", "colour": [255, 255, 255]},
+     {"op": "blur", "sigma": 1.5}]
+
+    The description is parsed and checked once here; unknown ops or
+    params raise ValueError. setup() allocates every buffer for a
+    strip length and run() then renders each frame into self.frame
+    without parsing anything or allocating new arrays.
+    """
+
+    def __init__(self, stages):
+        if not isinstance(stages, list) or not stages:
+            raise ValueError("stages must be a non-empty list")
+        self.stages = []
+        for spec in stages:
+            try:
+                params = dict(spec)
+                op = params.pop("op")
+                cls = STAGES[op]
+            except (TypeError, ValueError, KeyError):
+                raise ValueError(f"Invalid stage {spec}")
+            try:
+                self.stages.append(cls(**params))
+            except TypeError as e:
+                raise ValueError(f"Invalid {op} stage {spec}: {e}")
+        self.frame = None
+
+    def setup(self, n):
+        self.frame = np.zeros((3, n))
+        for stage in self.stages:
+            stage.setup(n)
+        return self
+
+    def run(self, t, dt, mel=None):
+        """Render the frame at time t, dt after the previous one"""
+        frame = self.frame
+        for stage in self.stages:
+            stage(frame, t, dt, mel)
+        return frame
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import struct
+
+import numpy as np
+
+import broadcast
+from .StripShow import StripShow
+
+logger = logging.getLogger(__name__)
+
+################################################################
+# Frame format
+#
+# Each frame is one UDP datagram or MQTT message: a header then the
+# pixels, either RGB byte triplets or packed 24-bit colours as
+# little-endian uint32 (as the LED buffer holds them). offset is the
+# first pixel of the substrip the frame starts at so long strips can
+# be sent in several parts.
+HEADER = struct.Struct("!2sBBIHH")  # magic, version, format, seq, offset, count
+MAGIC = b"LP"
+VERSION = 1
+RGB = 0
+PACKED = 1
+BYTES_PER_PIXEL = {RGB: 3, PACKED: 4}
+
+
+def pack_frame(seq, pixels, offset=0):
+    """Make a frame from an (n, 3) uint8 RGB array or an (n,) array of
+    packed colours. For senders; eg a desktop effect generator."""
+    pixels = np.asarray(pixels)
+    if pixels.ndim == 2:
+        fmt = RGB
+        data = pixels.astype(np.uint8)
+    else:
+        fmt = PACKED
+        data = pixels.astype("<u4")
+    return HEADER.pack(MAGIC, VERSION, fmt, seq & 0xffffffff, offset,
+                       len(pixels)) + data.tobytes()
+
+
+class PixelStream(StripShow):
+    """Shows frames streamed from elsewhere, eg effects rendered on a
+    desktop at full frame rate. Args:
+    address : "udp://<host>:<port>" (a multicast group is joined) or
+              "mqtt:<topic>"
+    timeout : seconds without a frame before logging that the stream
+              has stopped (default 1.0, at least MIN_TIMEOUT); the
+              last frame is held
+
+    Only the newest frame (or part of a frame, for each offset) is
+    shown; parts older than one already received for their offset (by
+    sequence number) are dropped. Frames are decoded with
+    np.frombuffer and copied straight into the substrip LED buffer.
+    """
+
+    MIN_TIMEOUT = 0.02
+    """About a frame; a shorter timeout would wake paint() over and
+    over while no frame is pending"""
+
+    ARGS = {"address": "str", "timeout": ("number", MIN_TIMEOUT, None)}
+
+    def __init__(self, controller, args):
+        super().__init__(controller, args)
+        self.address = args.get("address", "udp://0.0.0.0:5006")
+        if not (self.address.startswith("udp://") or
+                self.address.startswith("mqtt:")):
+            raise ValueError(f"Unknown stream address {self.address}")
+        self.timeout = args.get("timeout", 1.0)
+        # Pending part and last sequence number for each offset
+        self._pending = {}
+        self._last_seq = {}
+        self._event = None
+        self.received = 0
+        self.dropped = 0
+        self.shown = 0
+
+    def receive(self, data):
+        """Take a frame from the network. It's only decoded when shown
+        so a burst just replaces the pending part at its offset."""
+        try:
+            magic, version, fmt, seq, offset, count = HEADER.unpack_from(data)
+        except struct.error:
+            return
+        if magic != MAGIC or version != VERSION:
+            return
+        size = BYTES_PER_PIXEL.get(fmt)
+        if size is None or len(data) < HEADER.size + count * size:
+            logger.debug("Dropping bad frame (format %d, %d pixels in %d "
+                         "bytes)", fmt, count, len(data))
+            return
+        self.received += 1
+        last = self._last_seq.get(offset)
+        if last is not None:
+            gap = (seq - last) & 0xffffffff
+            if gap == 0 or gap > 0x7fffffff:
+                # Late or repeated
+                self.dropped += 1
+                return
+        self._last_seq[offset] = seq
+        if offset in self._pending:
+            # Superseded before it was shown
+            self.dropped += 1
+        self._pending[offset] = (fmt, count, data)
+        if self._event is not None:
+            self._event.set()
+
+    def _decode(self, fmt, offset, count, data):
+        count = min(count, self.numPixels - offset)
+        if count <= 0:
+            return None
+        if fmt == PACKED:
+            return np.frombuffer(data, dtype="<u4", count=count,
+                                 offset=HEADER.size)
+        rgb = np.frombuffer(data, dtype=np.uint8, count=count * 3,
+                            offset=HEADER.size).reshape(count, 3)
+        out = self._packed[:count]
+        tmp = self._tmp[:count]
+        np.left_shift(rgb[:, 0], 16, out=out, dtype=np.uint32)
+        np.left_shift(rgb[:, 1], 8, out=tmp, dtype=np.uint32)
+        out |= tmp
+        out |= rgb[:, 2]
+        return out
+
+    async def paint(self):
+        self._packed = np.zeros(self.numPixels, dtype=np.uint32)
+        self._tmp = np.zeros(self.numPixels, dtype=np.uint32)
+        self._event = asyncio.Event()
+        transport = None
+        topic = None
+        if self.address.startswith("udp://"):
+            try:
+                transport = await broadcast.listen_udp(self.address,
+                                                       self.receive)
+            except (OSError, ValueError) as e:
+                logger.error("Can't listen on %s: %s", self.address, e)
+                self.running = False
+                return
+        else:
+            topic = self.address[len("mqtt:"):]
+            self.controller.addStreamHandler(topic, self.receive)
+        logger.info("Streaming pixels from %s", self.address)
+        stalled = False
+        try:
+            while self.running:
+                try:
+                    await asyncio.wait_for(self._event.wait(), self.timeout)
+                except asyncio.TimeoutError:
+                    if not stalled:
+                        logger.info("No frames from %s, holding",
+                                    self.address)
+                        stalled = True
+                    continue
+                self._event.clear()
+                stalled = False
+                pending, self._pending = self._pending, {}
+                shown = False
+                for offset, (fmt, count, data) in pending.items():
+                    pixels = self._decode(fmt, offset, count, data)
+                    if pixels is None:
+                        continue
+                    for s in self.strips:
+                        s.setPixels(pixels, offset)
+                    shown = True
+                if not shown:
+                    continue
+                self.shown += 1
+                yield True
+        finally:
+            if transport is not None:
+                transport.close()
+            if topic is not None:
+                self.controller.removeStreamHandler(topic)
+            logger.debug("%s: received %d, shown %d, dropped %d",
+                         self.__class__.__name__, self.received,
+                         self.shown, self.dropped)
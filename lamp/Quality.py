@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+LADDER = ("bins", "blur", "smoothing", "resolution", "fps")
+"""The steps taken as the lamp runs short of CPU, cheapest loss first.
+At level n the first n steps apply:
+  bins       : analyse half as many mel bands (and stretch them back)
+  blur       : skip blurs
+  smoothing  : skip a painter's own smoothing filters
+  resolution : render half the pixels and double them up
+  fps        : render at half the frame rate
+A show lists the steps it can take in its QUALITY and ignores others.
+"""
+
+
+class QualityController:
+    """Steps music shows down the LADDER when frames overrun or the
+    event loop lags and back up when there is headroom again.
+
+    Shows call frame() with how long each frame took to make and how
+    long it had. run() measures how late the loop wakes from a sleep
+    and once a period decides:
+    - pressure (more than OVERRUN_HIGH of frames overran or the lag
+      reached LAG_HIGH) steps down a level straight away
+    - headroom (at most OVERRUN_LOW overran and the lag stayed under
+      LAG_LOW) for recover seconds steps up a level
+    If pressure comes back within recover seconds of stepping up the
+    next recover is doubled (up to MAX_RECOVER) so a load that only
+    just fits doesn't flap; it's reset once back at full quality.
+
+    level is read by the shows each frame. on_change(level, stats) is
+    called with each decision.
+    """
+    OVERRUN_HIGH = 0.1
+    OVERRUN_LOW = 0.02
+    LAG_HIGH = 0.05
+    LAG_LOW = 0.01
+    MAX_RECOVER = 120.0
+
+    def __init__(self, enabled=True, max_level=len(LADDER), period=1.0,
+                 recover=10.0, on_change=None):
+        self.enabled = enabled
+        self.max_level = min(max_level, len(LADDER))
+        self.period = period
+        self.base_recover = recover
+        self.recover = recover
+        self.on_change = on_change
+        self.level = 0
+        self.frames = 0
+        self.overruns = 0
+        self.lag = 0.0
+        self.steps_down = 0
+        self.steps_up = 0
+        self._headroom_since = None
+        self._stepped_up_at = None
+
+    def applies(self, step, quality):
+        """True if step is taken at the current level by a show which
+        can take the steps in quality"""
+        return step in quality and LADDER.index(step) < self.level
+
+    def frame(self, elapsed, interval):
+        """A show took elapsed seconds to make a frame due every
+        interval seconds"""
+        self.frames += 1
+        if elapsed > interval:
+            self.overruns += 1
+
+    def stats(self):
+        return {"level": self.level,
+                "steps": list(LADDER[:self.level]),
+                "frames": self.frames,
+                "overruns": self.overruns,
+                "lag_ms": round(self.lag * 1000, 1),
+                "steps_down": self.steps_down,
+                "steps_up": self.steps_up,
+                "recover": self.recover}
+
+    def decide(self, now):
+        """Look at the last period and maybe change level"""
+        overrun = self.overruns / self.frames if self.frames else 0.0
+        if overrun > self.OVERRUN_HIGH or self.lag >= self.LAG_HIGH:
+            self._headroom_since = None
+            if self.level < self.max_level:
+                if (self._stepped_up_at is not None and
+                        now - self._stepped_up_at < self.recover):
+                    self.recover = min(self.recover * 2, self.MAX_RECOVER)
+                self._stepped_up_at = None
+                self.steps_down += 1
+                self._change(self.level + 1, "down", overrun)
+        elif overrun <= self.OVERRUN_LOW and self.lag < self.LAG_LOW:
+            if self._headroom_since is None:
+                self._headroom_since = now
+            elif now - self._headroom_since >= self.recover and self.level:
+                self._headroom_since = now
+                self._stepped_up_at = now
+                self.steps_up += 1
+                if self.level == 1:
+                    self.recover = self.base_recover
+                self._change(self.level - 1, "up", overrun)
+        else:
+            self._headroom_since = None
+        self.frames = self.overruns = 0
+        self.lag = 0.0
+
+    def _change(self, level, direction, overrun):
+        self.level = level
+        logger.info("Quality %s to level %d %s (%.0f%% frames overran, "
+                    "loop lag %.1fms)", direction, level,
+                    list(LADDER[:level]), overrun * 100, self.lag * 1000)
+        if self.on_change:
+            self.on_change(level, self.stats())
+
+    async def run(self, interval=0.05):
+        """Measure the loop lag and decide every period"""
+        if not self.enabled:
+            return
+        last = time.monotonic()
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self.lag = max(self.lag, now - start - interval)
+            if now - last >= self.period:
+                last = now
+                self.decide(now)
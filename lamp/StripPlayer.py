@@ -1,9 +1,21 @@
+import asyncio
+import importlib
 import json
 import logging
+import os
+import signal
+import sys
+import time
+
+import broadcast
+import dsp
+from tracing import tracer
 
-from .StripShow import *
 from .StripState import StripState
-from .MusicShow import *
+from .FlightRecorder import FlightRecorder
+from .PainterRegistry import registry
+from .Clock import SharedClock
+from .Quality import QualityController, LADDER
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +33,42 @@ class StripPlayer:
     first_pixel = 0
     num_pixels = 140
 
+    A substrip may also have a layout (see Layout.compile_layout) so
+    its painters draw a logical frame which is mapped onto the
+    pixels, eg layout = "mirror" to paint from the centre out or
+    layout = {segments = [[0, 70], [0, 70, true]]} to show the same
+    70 pixels twice, the second time reversed.
+
+    The [strips] section may also set recorder_seconds (default 10)
+    and recorder_path (default /tmp) for the flight recorder which
+    keeps the last few seconds of frames sent to the strip. It is
+    dumped to an .npz in recorder_path on SIGUSR1 or a .../<NAME>/dump
+    message (whose payload may name the file).
+
+    SIGUSR2 or a .../<NAME>/trace message (payload is the seconds,
+    default trace_seconds = 10) records a trace of where frame time
+    goes, sampling one frame in trace_sample (default 1), and writes
+    it to recorder_path as Chrome trace event JSON for
+    ui.perfetto.dev or chrome://tracing.
+
+    Lamps in a room can share a timeline so time based shows stay in
+    step: set clock = "master" in [strips] on one lamp and
+    clock = "peer" on the others (clock_topic defaults to
+    named/lamp/clock). The master publishes its time each second.
+
+    One lamp can analyse the audio for all the others: set
+    analysis_broadcast = "udp://239.255.42.42:5005" (or
+    "mqtt:<topic>") and optionally analysis_format = "float16" in
+    its [strips], and AUDIO_SOURCE = "remote:<the same address>" on
+    the others.
+
+    When the lamp is short of CPU the music shows step down a ladder
+    of cheaper rendering (see Quality.LADDER) and back up when it
+    recovers. quality = false in [strips] turns this off and
+    quality_max_level limits how far down it goes. Each change is
+    published to named/sensor/lamp/<NAME>/quality and recorded by the
+    flight recorder.
+
     A StripShow is an asyncio task that paints the LEDs for a SubStrip.
 
     When an MQTT message arrives it stops the current StripShow and
@@ -31,7 +79,8 @@ class StripPlayer:
     so the same show can be present multiple times.
     Equally multiple instances of the same show can be present on
     different strips (typically with different paramaters).
-    A show can take over a strip (using the mirror command).
+    A show can drive several runs of pixels, mirrored or reversed,
+    through a substrip with a segments layout.
 
     """
 
@@ -41,7 +90,7 @@ class StripPlayer:
         self.mpd_host = config.get('mpd_host', "mpd")
         self.strip = strip
         self.mqctrl = mqctrl
-        mqctrl.add_handler(self.msg_handler)
+        mqctrl.add_handler(self.traced_msg_handler)
         mqctrl.subscribe(f"named/control/lamp/{self.name}/#")
         self.initialised = False
         mqctrl.subscribe(f"named/sensor/lamp/{self.name}/#")
@@ -54,19 +103,191 @@ class StripPlayer:
         for sname in config.keys():
             if isinstance(config[sname], dict):
                 self.strips[sname] = StripState(sname, strip, config)
-        logger.debug(f"strips {self.strips}")
+        logger.debug("strips %s", self.strips)
         self.effects = []
         self.music_playing = False
         self._state = True
+        # Always-on record of what was sent to the strip
+        self.recorder = FlightRecorder(strip,
+                                       config.get("recorder_seconds", 10),
+                                       streams=len(self.strips))
+        self.recorder_path = config.get("recorder_path", "/tmp")
+        self.trace_seconds = config.get("trace_seconds", 10)
+        self.trace_sample = config.get("trace_sample", 1)
+        # Optional timeline shared with other lamps
+        self.clock = SharedClock(config.get("clock", "local"))
+        self.clock_topic = config.get("clock_topic", "named/lamp/clock")
+        if self.clock.mode == "peer":
+            mqctrl.subscribe(self.clock_topic)
+        self.quality = QualityController(
+            config.get("quality", True),
+            config.get("quality_max_level", len(LADDER)),
+            on_change=self.qualityChanged)
+        self.analysis_broadcast = config.get("analysis_broadcast")
+        self.analysis_format = config.get("analysis_format", "uint8")
+        self.broadcaster = None
+        # Topics carrying binary streams (eg PixelStream frames)
+        self.stream_handlers = {}
+        source = dsp.config.AUDIO_SOURCE
+        if source.startswith("remote:mqtt:"):
+            mqctrl.subscribe(source[len("remote:mqtt:"):])
 
     async def run(self):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, self.dumpRecorder)
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR2, self.startTrace)
+        if self.clock.mode == "master":
+            self._clock_task = asyncio.create_task(
+                self.clock.run(self.mqctrl.publish, self.clock_topic))
+        if self.analysis_broadcast:
+            self.startBroadcast()
+        self._quality_task = asyncio.create_task(self.quality.run())
         await self.mqctrl.run()
         self.exit()
 
+    def addStreamHandler(self, topic, handler):
+        """Pass the raw payloads of topic to handler(payload)"""
+        self.stream_handlers[topic] = handler
+        self.mqctrl.subscribe(topic)
+
+    def removeStreamHandler(self, topic):
+        self.stream_handlers.pop(topic, None)
+        unsubscribe = getattr(self.mqctrl, "unsubscribe", None)
+        if unsubscribe:
+            unsubscribe(topic)
+
+    def startBroadcast(self):
+        """Analyse the audio here and send it to other lamps"""
+        music = importlib.import_module(".MusicShow", __package__)
+        try:
+            self.broadcaster = music.MusicShow.broadcaster(
+                self.analysis_broadcast, self.analysis_format,
+                self.mqctrl.publish)
+        except (ValueError, OSError) as e:
+            logger.error("Can't broadcast analysis to %s: %s",
+                         self.analysis_broadcast, e)
+            return
+        logger.info("Broadcasting analysis to %s", self.analysis_broadcast)
+        self._broadcast_task = asyncio.create_task(self.broadcaster.run())
+
+    def dumpRecorder(self, name=None):
+        """Write the flight recorder to an .npz file in recorder_path,
+        called name if given. The snapshot is taken now and written
+        in a thread."""
+        if not name:
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            name = f"lamp-{self.name}-{stamp}.npz"
+        # The name comes over MQTT so it may only pick a file in
+        # recorder_path, not a path to write anywhere else
+        if (not isinstance(name, str) or os.path.basename(name) != name or
+                name in (".", "..")):
+            logger.warning("Not dumping the recorder to %r: "
+                           "not a file name", name)
+            return
+        if not name.endswith(".npz"):
+            name += ".npz"
+        path = os.path.join(self.recorder_path, name)
+        snapshot = self.recorder.snapshot()
+        asyncio.get_running_loop().run_in_executor(
+            None, FlightRecorder.dump, snapshot, path)
+
+    def qualityChanged(self, level, stats):
+        self.recorder.quality = level
+        # Before then our sensor topic is used to restore our state
+        # (msg_handler never restores from this subtopic)
+        if self.initialised:
+            self.mqctrl.publish(
+                f"named/sensor/lamp/{self.name}/quality",
+                json.dumps(stats, separators=(',', ':')).encode())
+
+    def startTrace(self, seconds=None):
+        """Trace for seconds then write the trace to a .json file"""
+        if tracer.enabled:
+            logger.info("Already tracing")
+            return
+        seconds = seconds or self.trace_seconds
+        tracer.enable(self.trace_sample)
+        asyncio.get_running_loop().call_later(seconds, self.stopTrace)
+
+    def stopTrace(self):
+        tracer.disable()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = f"{self.recorder_path}/lamp-{self.name}-{stamp}.json"
+        trace = tracer.export()
+        asyncio.get_running_loop().run_in_executor(
+            None, tracer.dump, trace, path)
+
+    async def reconfigure(self, config):
+        """Apply a new [strips] config without stopping anything that
+        hasn't changed.
+
+        Substrips which are new, gone or have moved are rebuilt; those
+        which have moved keep their painters. Running shows, the strip
+        and the mic are left alone. Returns how long, in seconds, any
+        rebuilt substrip was dark for (0.0 if none were).
+        """
+        if config.get("name", self.name) != self.name:
+            logger.warning("Lamp name change needs a restart")
+        gone = []
+        start = time.monotonic()
+        for sname, striph in list(self.strips.items()):
+            new = config.get(sname)
+            if (isinstance(new, dict) and
+                    new.get("first_pixel") == striph.first_pixel and
+                    new.get("num_pixels") == striph.num_pixels and
+                    new.get("layout") == striph.layout):
+                continue
+            if striph.current_show:
+                await striph.current_show.removeStrip(striph.ss)
+                striph.current_show = None
+            striph.ss.off()
+            del self.strips[sname]
+            gone.append(striph)
+        made = []
+        for sname, info in config.items():
+            if isinstance(info, dict) and sname not in self.strips:
+                striph = StripState(sname, self.strip, config)
+                # A moved substrip carries on with the same painters
+                for old in gone:
+                    if old.name == sname:
+                        if old.quiet:
+                            striph.quiet = old.quiet
+                        striph.music = old.music
+                self.strips[sname] = striph
+                made.append(sname)
+        if not (gone or made):
+            return 0.0
+        logger.info("Substrips removed %s, made %s",
+                    [s.name for s in gone], made)
+        self.recorder.resize(len(self.strips))
+        count = self.recorder.count
+        for sname in made:
+            await self.setPainter(sname)
+        # Dark until a show has sent a frame to the strip
+        deadline = time.monotonic() + 1.0
+        while (made and self.recorder.count == count and
+               time.monotonic() < deadline):
+            await asyncio.sleep(0.005)
+        self.publishState()
+        return time.monotonic() - start
+
     async def cleanup(self):
+        self._quality_task.cancel()
+        if self.broadcaster:
+            self._broadcast_task.cancel()
+            try:
+                await self._broadcast_task
+            except asyncio.CancelledError:
+                pass
         for show in self.shows.values():
             logger.debug(f"stopping show {show}")
             await show.stop()
+        # The mic may be lingering with no clients. It only exists if
+        # a music painter has been loaded
+        music = sys.modules.get("lamp.MusicShow")
+        if music and music.MusicShow.mic:
+            await music.MusicShow.mic.close()
 
         # for strip in self.strips.values():
         #     logger.debug(f"stopping strip {strip}")
@@ -104,11 +325,17 @@ class StripPlayer:
         logger.debug("Music_playing handled")
         return True
 
+    async def traced_msg_handler(self, topic, rawpayload):
+        with tracer.span("mqtt", "mqtt"):
+            return await self.msg_handler(topic, rawpayload)
+
     async def msg_handler(self, topic, rawpayload):
         """
         Message format is:
         named/control/lamp/{NAME}/brightness
         named/control/lamp/{NAME}/state
+        named/control/lamp/{NAME}/dump  (payload is an optional file name)
+        named/control/lamp/{NAME}/trace  (payload is optional seconds)
         # named/control/lamp/{NAME}/strip/{NAME}/painter/{PAINTER}
         # named/control/lamp/{NAME}/strip/{NAME}/mirror/{NAME2}
         # named/control/lamp/{NAME}/state
@@ -135,9 +362,24 @@ class StripPlayer:
         # named/control/lamp/{NAME}/strip/{NAME}/mirror/{NAME2}
 
         """
-        logger.debug(f"Handler got msg {topic}")
+        if topic == self.clock_topic:
+            self.clock.handle(rawpayload)
+            return True
+        if broadcast.deliver(topic, rawpayload):
+            return True
+        handler = self.stream_handlers.get(topic)
+        if handler:
+            handler(rawpayload)
+            return True
+        logger.debug("Handler got msg %s", topic)
         if topic == f"mpd/{self.mpd_host}/player":
             return await self.msg_mpd_handler(topic, rawpayload)
+        if not (topic.startswith(f"named/control/lamp/{self.name}") or
+                topic.startswith(f"named/sensor/lamp/{self.name}")):
+            # eg frames still arriving on a stream topic after its
+            # show stopped
+            logger.debug("Ignoring message on %s", topic)
+            return False
         # Subscribe to our own published state and use it to restore
         # 'last known' state but only once.
         # Doing it this way slightly optimises the check
@@ -147,16 +389,20 @@ class StripPlayer:
         if topic.startswith(f"named/sensor/lamp/{self.name}"):
              if self.initialised:  # Ignore once initialised
                  return True
+             # Only our saved state restores us; subtopics such as
+             # .../quality carry stats and may be retained too
+             if topic != f"named/sensor/lamp/{self.name}":
+                 return True
              # now fall through and use the sensor/ payload
              self.initialised = True
              logger.debug("Using last published value to initialise\n%s",
                           rawpayload.decode("utf-8"))
-        logger.debug(f"rawpayload {rawpayload}")
+        logger.debug("rawpayload %s", rawpayload)
         topics = topic.split("/")[3:]
         name = topics[0]
 
         if name != self.name:
-            logger.debug(f"Message is for {name}, not me {self.name}")
+            logger.debug("Message is for %s, not me %s", name, self.name)
             return False
 
         # Handle an incoming .../<name>/strip/<strip>|all/painter msg
@@ -183,12 +429,14 @@ class StripPlayer:
                     # named/control/lamp/{NAME}/<attr> (brightness or state)
                     val = rawpayload.decode("utf-8") or "None"
                     payload = {attr: val}
+                elif attr in ["dump", "trace"]:
+                    payload = {attr: rawpayload.decode("utf-8")}
                 else:
-                    logger.debug(f"Unknown attribute {attr}")
+                    logger.debug("Unknown attribute %s", attr)
                     return False
             elif len(topics) == 1:  # {NAME}
                 payload = json.loads(rawpayload.decode("utf-8") or "null")
-            logger.debug(f"Converted to {payload}")
+            logger.debug("Converted to %s", payload)
         except json.JSONDecodeError:
             logger.warning("Error decoding 'strip' payload")
             return False
@@ -200,6 +448,13 @@ class StripPlayer:
             await self.setState(payload["state"])
         if "brightness" in payload:
             await self.setBrightness(int(payload["brightness"]))
+        if "dump" in payload:
+            self.dumpRecorder(payload["dump"])
+        if "trace" in payload:
+            try:
+                self.startTrace(float(payload["trace"] or 0))
+            except ValueError:
+                logger.warning("Bad trace seconds %r", payload["trace"])
         if "pixels" in payload:
             logger.warning("pixels attr is readonly")
         if "strips" in payload:
@@ -212,7 +467,7 @@ class StripPlayer:
                     return True
                 if sname == "all":
                     for sname in self.strips.keys():
-                        logger.debug(f"Paint strip {sname} {info}")
+                        logger.debug("Paint strip %s %s", sname, info)
                         await self.storePainter(sname, info)
                 else:
                     await self.storePainter(sname, info)
@@ -227,7 +482,7 @@ class StripPlayer:
         and the args to the particular painter.
 
         """
-        logger.debug(f"storePainter({sname}, {args})")
+        logger.debug("storePainter(%s, %s)", sname, args)
         # validate here
         music = args.get("music_painter", None)
         try:
@@ -247,10 +502,10 @@ class StripPlayer:
                 logger.warning(f"Invalid json: {quiet}")
                 quiet = None
         if music:
-            logger.debug(f"music: {music}")
+            logger.debug("music: %s", music)
             self.strips[sname].music = music
         if quiet:
-            logger.debug(f"quiet: {quiet}")
+            logger.debug("quiet: %s", quiet)
             self.strips[sname].quiet = quiet
         await self.setPainter(sname)
 
@@ -293,17 +548,26 @@ class StripPlayer:
         except KeyError:
             try:
                 cls = args["name"]
-                newshow = globals()[cls](self, args)
-                self.shows[key] = newshow
-                logger.debug("setPainter(%s): Created show %s with key %s",
-                             sname, cls, key)
             except KeyError:
                 logger.debug("setPainter(%s): Np painter class in args", sname)
                 return
-            except NameError:
-                logger.debug("setPainter(%s): invalid painter class: %s",
-                             sname, cls)
+            try:
+                newshow = registry.create(cls, self, args)
+            except KeyError:
+                logger.warning("setPainter(%s): invalid painter class: %s",
+                               sname, cls)
+                return
+            except ImportError as e:
+                logger.warning("setPainter(%s): can't load painter %s: %s",
+                               sname, cls, e)
+                return
+            except ValueError as e:
+                logger.warning("setPainter(%s): invalid %s args: %s",
+                               sname, cls, e)
                 return
+            self.shows[key] = newshow
+            logger.debug("setPainter(%s): Created show %s with key %s",
+                         sname, cls, key)
 
         if striph.current_show == newshow:
             logger.debug("setPainter(%s): Already in show %s",
@@ -326,14 +590,15 @@ class StripPlayer:
         #                         self.painter._as_payload())
 
     async def setBrightness(self, b):
-        logger.debug(f"Setting brightness to {b}")
+        logger.debug("Setting brightness to %s", b)
         self.strip.setBrightness(b)
         # Now run a frame of the strip show in case it's static
         self.strip.show()
+        self.recorder.record("setBrightness")
 
     async def setState(self, s):
         state = s in ("ON", "on", "On", "True", "true", "1")
-        logger.debug(f"Setting state ({s}) to {state}")
+        logger.debug("Setting state (%s) to %s", s, state)
         self._state = state
         if state:
             for sname in self.strips.keys():
@@ -371,7 +636,7 @@ class StripPlayer:
             }
 
         msg = json.dumps(payload, sort_keys=True).encode()
-        logger.debug(f"Publish {msg}")
+        logger.debug("Publish %s", msg)
 
         self.mqctrl.publish(f"named/sensor/lamp/{self.name}", msg)
 
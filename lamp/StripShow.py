@@ -9,9 +9,33 @@ import json
 import logging
 import numpy as np
 import config
+from tracing import tracer
+from .Particles import Particles
+from .Pipeline import Pipeline, rgb_to_frame
+from .FrameCache import frame_cache
+from .Clock import local_clock
 logger = logging.getLogger(__name__)
 
 
+def hue_to_colours(h):
+    """Vectorised StripShow.hue_to_rgb(): converts an array of 0-255
+    hues to packed Colour() values, bit for bit the same as going
+    through colorsys.hsv_to_rgb(h/255, 1, 1)"""
+    h = np.asarray(h, dtype=float) / 255
+    i = (h * 6.0).astype(int)
+    f = (h * 6.0) - i
+    q = 1.0 - f
+    t = 1.0 - (1.0 - f)
+    i = i % 6
+    one = np.ones_like(h)
+    zero = np.zeros_like(h)
+    r = np.choose(i, (one, q, zero, zero, t, one))
+    g = np.choose(i, (t, one, one, q, zero, zero))
+    b = np.choose(i, (zero, zero, t, one, one, q))
+    r, g, b = [(c * 255).astype(np.uint32) for c in (r, g, b)]
+    return (r << 16) | (g << 8) | b
+
+
 class StripShow:
     '''Define various ways to animate LEDs in a SubStrip.
 
@@ -34,8 +58,12 @@ class StripShow:
     Painters have access to the decoded message payload via the
     self.args attribute
 
+    Painters describe their args in ARGS (see PainterRegistry) and
+    they are checked before the show is made.
     '''
 
+    ARGS = {}
+
     def __init__(self, controller, args):
         self.controller = controller
         self.strips = []
@@ -45,10 +73,20 @@ class StripShow:
         self.task = None
         self.args = args
         self.numPixels = 0
+        self.layout = None
+        """Optional Layout.Layout for painters which draw a smaller
+        logical frame (eg half the strip) for setPixels() to map onto
+        numPixels"""
         self._gamma = np.load(config.GAMMA_TABLE_PATH)
         """Gamma lookup table used for nonlinear brightness correction"""
 
 
+    @property
+    def clock(self):
+        """The SharedClock time based painters should use so lamps
+        in sync mode show the same frame at the same time"""
+        return getattr(self.controller, "clock", None) or local_clock
+
     def _as_payload(self):
         return json.dumps(self.args, separators=(',', ':')).encode("utf-8")
 
@@ -62,7 +100,7 @@ class StripShow:
                 return False
         self.strips.append(strip)
         self.numPixels = strip.numPixels()
-        logger.debug(f"{self.name} has {self.numPixels} pixels")
+        logger.debug("%s has %d pixels", self.name, self.numPixels)
         if not self.running:
             self.start()
         return True
@@ -74,7 +112,7 @@ class StripShow:
         logger.debug("%s has %d strips now", self.name, l)
         if not l:
             self.numPixels = 0
-            logger.debug(f"{self.name} has no more strips - stopping")
+            logger.debug("%s has no more strips - stopping", self.name)
             await self.stop()
             self.running = False
         return l
@@ -82,13 +120,15 @@ class StripShow:
     def start(self):
         self.running = True
         self.task = asyncio.create_task(self.show())
-        logger.debug(f"The show must go on. Let's {self.name} in {self.task.get_name()}")
+        logger.debug("The show must go on. Let's %s in %s",
+                     self.name, self.task.get_name())
 
     async def stop(self):
         """Stops the show"""
-        logger.debug(f"{self.__class__.__name__} stop()")
+        logger.debug("%s stop()", self.__class__.__name__)
         if not self.running:
-            logger.debug(f"{self.__class__.__name__} already stopped/stopping")
+            logger.debug("%s already stopped/stopping",
+                         self.__class__.__name__)
             return
         self.running = False
         if self.task:
@@ -102,32 +142,51 @@ class StripShow:
                     await self.task
                 except asyncio.CancelledError:
                     # Or just accept it got hard-cancelled
-                    logger.debug(f"The {self.name} show was hard cancelled")
+                    logger.debug("The %s show was hard cancelled",
+                                 self.name)
         colour = Colour(0, 0, 0)
         for s in self.strips:
             s.off()
         await self.showHasFinished()
-        logger.debug(f"The {self.name} show is over")
+        logger.debug("The %s show is over", self.name)
 
     async def show(self):
-        logger.error(f"showing {self.name}")
+        logger.debug("showing %s", self.name)
+        recorder = getattr(self.controller, "recorder", None)
+        show_name = self.__class__.__name__
+        last_frame = time.monotonic()
         while True:
             if self.running:
                 # paint frames.
                 try:
+                    # The "paint" span runs from the end of one frame
+                    # to the painter's next yield so includes its
+                    # sleeps; prepare and fft spans nest inside it
+                    tracer.frame()
+                    painted = time.perf_counter_ns()
                     # This may never finish
                     async for _frame in self.paint():
+                        if tracer.recording:
+                            tracer.add("paint", show_name, painted,
+                                       time.perf_counter_ns() - painted)
                         try:
                             # We assume there's only 1 actual strip
                             # which is split into subsstrips so we
                             # only need to render one strip. This may
                             # change if we have multiple real strips
-                            self.strips[0].show()
+                            with tracer.span("strip.show", "strip"):
+                                self.strips[0].show()
+                            if recorder:
+                                now = time.monotonic()
+                                recorder.record(show_name, now - last_frame)
+                                last_frame = now
                         except IndexError:
                             # We have had our strips removed !
                             if self.running:
                                 logger.critical("No strips but still runnning???")
                             pass
+                        tracer.frame()
+                        painted = time.perf_counter_ns()
 
                 except asyncio.CancelledError:
                     return
@@ -147,6 +206,14 @@ class StripShow:
         for s in self.strips:
             s.setPixelColor(p, c)
 
+    def setPixels(self, pixels):
+        """Write a whole frame of packed colours (eg from
+        prepare_for_strip()) to every strip in one go"""
+        if self.layout is not None:
+            pixels = self.layout.map(pixels)
+        for s in self.strips:
+            s.setPixels(pixels)
+
     def hue_to_rgb(self, h):
         """Utility function for Painters. Converts a 0-255 hue into a
         Colour()"""
@@ -154,6 +221,10 @@ class StripShow:
             [int(c * 255) for c in colorsys.hsv_to_rgb(h/255, 1, 1)]))
 
     def prepare_for_strip(self, pixels):
+        with tracer.span("prepare"):
+            return self._prepare_for_strip(pixels)
+
+    def _prepare_for_strip(self, pixels):
         # Truncate values and cast to integer
         pixels = np.clip(pixels, 0, 255).astype(int)
         # Optional gamma correction
@@ -169,9 +240,78 @@ class StripShow:
         return np.bitwise_or(np.bitwise_or(r, g), b)
 
 
+class PeriodicShow(StripShow):
+    """Base for painters that are a pure function of time and their
+    args and repeat exactly.
+
+    Unless the "cache" arg is false one whole cycle is rendered into
+    a (frames, numPixels) array of packed colours the first time it
+    is needed and playing it is then just copying the frame for the
+    current time into the strip. Cycles are shared through the
+    FrameCache, keyed by painter, args and pixel count and bounded by
+    config.FRAME_CACHE_BYTES. If the cycle won't fit paint_live() is
+    used instead.
+
+    Subclasses implement cycle(), render_cycle() and paint_live().
+    """
+
+    ARGS = {"cache": "bool"}
+
+    def cycle(self):
+        """Return (number of frames, seconds per frame) for one cycle"""
+        raise NotImplementedError
+
+    def render_cycle(self, count, frame_time):
+        """Return a (count, numPixels) uint32 array of packed frames"""
+        raise NotImplementedError
+
+    async def paint_live(self):
+        raise NotImplementedError
+        yield True
+
+    def cached_cycle(self):
+        """The frames for one cycle and the seconds per frame, or
+        (None, None) if they can't be cached"""
+        try:
+            count, frame_time = self.cycle()
+        except Exception as e:
+            logger.error(f"Error handling {self.__class__.__name__} args: {e}")
+            return None, None
+        if count * self.numPixels * 4 > frame_cache.budget:
+            logger.info("%s cycle of %d frames is too big to cache",
+                        self.__class__.__name__, count)
+            return None, None
+        key = (self.__class__.__name__, self._as_payload(), self.numPixels)
+        frames = frame_cache.get(key)
+        if frames is None:
+            frames = self.render_cycle(count, frame_time)
+            frame_cache.put(key, frames)
+            logger.debug("Cached %d frames for %s", count, key)
+        return frames, frame_time
+
+    async def paint(self):
+        frames = None
+        if self.args.get("cache", True):
+            frames, frame_time = self.cached_cycle()
+        if frames is None:
+            async for frame in self.paint_live():
+                yield frame
+            return
+        count = len(frames)
+        while self.running:
+            # Index by the clock so a cycle that is a function of time
+            # carries on where the live painter would be
+            k = int(self.clock.time() / frame_time)
+            self.setPixels(frames[k % count])
+            yield True
+            await asyncio.sleep(self.clock.until((k + 1) * frame_time))
+
+
 ################################################################
 # Painter Classes
 class RainbowFade(StripShow):
+    ARGS = {"speed": "number"}
+
     async def paint(self):
         """Fade through all the colours of a Rainbow"""
         try:
@@ -181,15 +321,17 @@ class RainbowFade(StripShow):
             self.running = False
             return
         while True:
-            t = time.time() * speed
+            t = self.clock.time() * speed
             colour = self.hue_to_rgb(t % 255)
             for i in range(self.numPixels):
                 self.setPixelColor(i, colour)
             yield True
-            await asyncio.sleep(1/60)
+            await asyncio.sleep(self.clock.until_next(1/60))
 
 
 class SolidColour(StripShow):
+    ARGS = {"colour": "colour"}
+
     async def paint(self):
         """Set the entire display to a colour."""
         try:
@@ -204,6 +346,8 @@ class SolidColour(StripShow):
 
 
 class SolidColourWipe(StripShow):
+    ARGS = {"colour": "colour", "wait_ms": ("number", 0, None)}
+
     async def paint(self):
         """Wipe colour across display a pixel at a time."""
         wait_ms = self.args.get("wait_ms", 50)
@@ -218,8 +362,28 @@ class SolidColourWipe(StripShow):
         self.running = False
 
 
-class TheaterChase(StripShow):
-    async def paint(self):
+class TheaterChase(PeriodicShow):
+    ARGS = {**PeriodicShow.ARGS,
+            "reverse": "bool",
+            "line_length": ("int", 1, None),
+            "wait_ms": ("number", 1, None),
+            "colour": "colour"}
+
+    def cycle(self):
+        return (self.args.get("line_length", 8),
+                self.args.get("wait_ms", 50) / 1000.0)
+
+    def render_cycle(self, count, frame_time):
+        reverse = -1 if self.args.get("reverse", False) else 1
+        colour = Colour(*self.args.get("colour", (255, 0, 0)))
+        num = self.numPixels
+        frames = np.zeros((count, num), dtype=np.uint32)
+        lit = np.arange(0, num, count)
+        for q in range(count):
+            frames[q, (lit + q * reverse) % num] = colour
+        return frames
+
+    async def paint_live(self):
         """Movie theater light style chaser animation."""
         try:
             reverse = self.args.get("reverse", False)
@@ -243,8 +407,30 @@ class TheaterChase(StripShow):
 
 
 
-class TheaterChaseRainbow(StripShow):
-    async def paint(self):
+class TheaterChaseRainbow(PeriodicShow):
+    ARGS = {**PeriodicShow.ARGS,
+            "reverse": "bool",
+            "line_length": ("int", 1, None),
+            "wait_ms": ("number", 1, None)}
+
+    def cycle(self):
+        # The hues step once per pass of the line, 256 passes in all
+        return (256 * self.args.get("line_length", 4),
+                self.args.get("wait_ms", 50) / 1000.0)
+
+    def render_cycle(self, count, frame_time):
+        reverse = -1 if self.args.get("reverse", False) else 1
+        line = self.args.get("line_length", 4)
+        num = self.numPixels
+        frames = np.zeros((count, num), dtype=np.uint32)
+        lit = np.arange(0, num, line)
+        for j in range(256):
+            colours = hue_to_colours((lit + j) % 255)
+            for q in range(line):
+                frames[j * line + q, (lit + q * reverse) % num] = colours
+        return frames
+
+    async def paint_live(self):
         """Rainbow movie theater light style chaser animation."""
         try:
             reverse = self.args.get("reverse", False)
@@ -270,8 +456,27 @@ class TheaterChaseRainbow(StripShow):
             j = (j+1) % 256
 
 
-class RainbowChase(StripShow):
-    async def paint(self):
+class RainbowChase(PeriodicShow):
+    ARGS = {**PeriodicShow.ARGS,
+            "reverse": "bool",
+            "speed": "number"}
+    FPS = 60
+
+    def cycle(self):
+        # The hues go round once every 255 / speed seconds
+        period = 255 / abs(self.args.get("speed", 10))
+        count = max(int(round(period * self.FPS)), 1)
+        return count, period / count
+
+    def render_cycle(self, count, frame_time):
+        reverse = -1 if self.args.get("reverse", False) else 1
+        speed = self.args.get("speed", 10)
+        n = self.numPixels
+        t = np.arange(count)[:, None] * frame_time * speed
+        h = (np.arange(n) / n) * 255
+        return hue_to_colours((t + h * reverse) % 255)
+
+    async def paint_live(self):
         """Draw rainbow that uniformly distributes itself across all pixels."""
         try:
             reverse = self.args.get("reverse", False)
@@ -283,79 +488,91 @@ class RainbowChase(StripShow):
         n = self.numPixels
         reverse = -1 if reverse else 1
         while True:
-            t = time.time() * speed
+            t = self.clock.time() * speed
             for i in range(n):
                 # Spread the Hue range over the pixels & also cycle it
                 # over time
                 h = (i / n) * 255  # scale to 0-255
                 self.setPixelColor(i, self.hue_to_rgb((t + h * reverse) % 255))
-            await asyncio.sleep(1/60)
+            await asyncio.sleep(self.clock.until_next(1/60))
             yield True
 
 class Sparkle(StripShow):
-    """Sparkles"""
+    """Sparkles
+
+    Built on Particles so many pixels can sparkle at once. Args:
+    colour     : [r, g, b] as for Colour(), or "random" (the default).
+                 Older versions took [g, r, b], so a saved [255, 0, 0]
+                 that was green is now red.
+    rate       : sparkles started per frame (default 1)
+    smoothness : power of the slope used to fade in and out. If it
+                 is zero the pixels appear suddenly and just fade
+                 using decay.
+    decay      : fraction of the sparkle's life used per frame, or
+                 the per frame multiplier if smoothness is zero;
+                 above 0 (default 0.01)
+    delay      : seconds to sleep between frames
+    seed       : seed for the random numbers
+    """
+
+    ARGS = {"colour": ("colour", "random"),
+            "rate": ("number", 0, None),
+            "smoothness": ("number", 0, None),
+            "decay": "positive",
+            "delay": ("number", 0, None),
+            "seed": ("int", 0, None)}
 
     async def paint(self):
-        import random
-
-        colour = self.args.get("colour",
-                               #[255, 0, 0]  # Green
-                               #[0, 255, 0]  # Red
-                               #[0, 0, 255]  # Blue
-                               "random"
-                               #[255, 255, 255]
-        )
+        colour = self.args.get("colour", "random")
         if colour == "random":
             colour = None
         else:
-            colour = np.array(colour)/255
-        # smoothness is the power of the slope used to fade in and out
-        # if smoothness is zero the pixels appear suddenly and just
-        # fade using decay.
+            colour = rgb_to_frame(colour)
+        rate = self.args.get("rate", 1)
         smoothness = self.args.get("smoothness", 1.0)
-        # Decay is subtracted if smoothness == 0 otherwise it's a multiplier
         decay = self.args.get("decay", 0.01)
         delay = self.args.get("delay", 0)
 
-        # make a 3xN array filled with 1.0
-        sparkles = np.tile(0.0, (3, self.numPixels))
-        logger.debug(f"Frame init {self.numPixels} {sparkles} ")
+        # Ages are counted in frames
+        if smoothness:
+            lifetime = 1.0 / decay
+        elif 0 < decay < 1:
+            # Until it has faded below one step
+            lifetime = np.log(1 / 255) / np.log(decay)
+        else:
+            lifetime = 1.0
+        capacity = max(int(np.ceil(rate * lifetime)), 1)
+        sparkles = Particles(capacity, self.numPixels,
+                             seed=self.args.get("seed"))
+        rng = sparkles.rng
+        # Fractional rates carry over between frames
+        owed = 0.0
+        logger.debug("Sparkle capacity %d for %d", capacity, self.numPixels)
         while self.running:
-
-            # Which pixel to glow
-            pixel = random.randint(0, self.numPixels-1)
-            val = sparkles[:, pixel]  # is it doing anything?
-            if val[0] or val[1] or val[2]: # val.any() doesn't
-                                           # short-circuit
-                pass  # Pixel already lit
-            else:
-                if colour is not None:
-                    sparkles[:, pixel] = colour
+            owed += rate
+            n = int(owed)
+            owed -= n
+            if n:
+                if colour is None:
+                    c = rng.random((3, n)) * 255
                 else:
-                    sparkles[:, pixel] = np.array([
-                        random.random(),
-                        random.random(),
-                        random.random(),
-                    ])
+                    c = colour
+                sparkles.spawn(n, rng.integers(0, self.numPixels, n),
+                               colour=c, lifetime=lifetime)
 
             if smoothness:
                 # Convert from 0.0 -> 1.0 to 0.0 -> 1.0 -> 0.0
-                pixels = (np.power(1 - np.fabs(sparkles + -0.5) * 2,
-                                   smoothness)
-                          * 255)
+                intensity = np.power(
+                    1 - np.abs(sparkles.phase() * 2 - 1), smoothness)
             else:
-                pixels = sparkles * 255
+                intensity = np.power(float(decay), sparkles.age)
+            pixels = sparkles.render(intensity)
 
             p = self.prepare_for_strip(pixels)
-            self.setPixelColor(slice(0, len(p)), p)
+            self.setPixels(p)
             yield True
 
-            # Now make the sparkles fade a bit for next time
-            if smoothness:
-                sparkles = np.fmax(sparkles - decay, 0.0)
-            else:
-                sparkles = sparkles * decay
-
+            sparkles.update(1)
             await asyncio.sleep(delay)
         logger.debug("%s: paint has finished", self.__class__.__name__)
 
@@ -380,3 +597,96 @@ class Sparkle(StripShow):
         pixels[2, s-1:s] = random.randrange(255)
 
         return pixels
+
+
+class Comets(StripShow):
+    """Comets with fading tails flying along the strip. Args:
+    colour   : [r, g, b] or "random" (the default)
+    rate     : comets launched per second (default 1)
+    speed    : pixels per second (default 60); each comet gets a
+               random speed up to 50% either side of this
+    reverse  : fly the other way; "both" for both ways
+    tail     : fraction of brightness kept per frame (default 0.8)
+    seed     : seed for the random numbers
+    """
+
+    ARGS = {"colour": ("colour", "random"),
+            "rate": ("number", 0, None),
+            "speed": ("number", 1, None),
+            "reverse": ("choice", True, False, "both"),
+            "tail": ("number", 0, 1),
+            "seed": ("int", 0, None)}
+
+    async def paint(self):
+        colour = self.args.get("colour", "random")
+        if colour != "random":
+            colour = rgb_to_frame(colour)
+        rate = self.args.get("rate", 1)
+        speed = self.args.get("speed", 60)
+        reverse = self.args.get("reverse", False)
+        tail = self.args.get("tail", 0.8)
+        fps = 60
+        # Comets leave the strip before they expire
+        lifetime = 2.0 * self.numPixels / (speed * 0.5)
+        capacity = max(int(np.ceil(rate * lifetime)), 1)
+        comets = Particles(capacity, self.numPixels,
+                           seed=self.args.get("seed"))
+        rng = comets.rng
+        last = time.monotonic()
+        owed = 0.0
+        while self.running:
+            now = time.monotonic()
+            dt = now - last
+            last = now
+            owed += rate * dt
+            n = int(owed)
+            owed -= n
+            if n:
+                if isinstance(colour, str):
+                    c = rng.random((3, n)) * 255
+                else:
+                    c = colour
+                v = speed * rng.uniform(0.5, 1.5, n)
+                if reverse == "both":
+                    v *= rng.choice((-1, 1), n)
+                elif reverse:
+                    v = -v
+                start = np.where(v < 0, self.numPixels - 1, 0)
+                comets.spawn(n, start, velocity=v, colour=c,
+                             lifetime=lifetime)
+            comets.update(dt)
+            pixels = comets.render(fade=tail)
+            self.setPixels(self.prepare_for_strip(pixels))
+            yield True
+            await asyncio.sleep(1 / fps)
+        logger.debug("%s: paint has finished", self.__class__.__name__)
+
+
+class Effect(StripShow):
+    """Runs a declarative Pipeline given as the "stages" arg, eg
+    {"name": "Effect", "fps": 60,
+     "stages": [{"op": "gradient", "colours": [[255, 0, 0], [0, 0, 255]],
+                 "speed": 20},
+                {"op": "mirror"}]}
+    The pipeline is compiled when the show is made so a bad
+    description is rejected by StripPlayer with a ValueError.
+    """
+
+    ARGS = {"stages": "list", "fps": ("number", 1, None)}
+
+    def __init__(self, controller, args):
+        super().__init__(controller, args)
+        self.pipeline = Pipeline(args.get("stages"))
+        self.fps = args.get("fps", 60)
+
+    async def paint(self):
+        pipeline = self.pipeline.setup(self.numPixels)
+        start = last = time.monotonic()
+        while self.running:
+            now = time.monotonic()
+            pixels = pipeline.run(now - start, now - last)
+            last = now
+            self.setPixels(self.prepare_for_strip(pixels))
+            yield True
+            await asyncio.sleep(1 / self.fps)
+        logger.debug("%s: paint has finished", self.__class__.__name__)
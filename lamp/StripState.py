@@ -1,7 +1,13 @@
 import hashlib
 import json
+import logging
 from typing import Dict, Any
 
+from .Layout import compile_layout
+from .SubStrip import SubStrip
+
+logger = logging.getLogger(__name__)
+
 class StripState:
     """Helper class that encapsulates the Strip state
     """
@@ -11,8 +17,13 @@ class StripState:
         self.strip = strip
         self.first_pixel = config[name]["first_pixel"]
         self.num_pixels = config[name]["num_pixels"]
-        self.ss = strip.createPixelSubStrip(self.first_pixel,
-                                            num=self.num_pixels)
+        self.layout = config[name].get("layout")
+        try:
+            layout = compile_layout(self.layout, self.num_pixels)
+        except ValueError as e:
+            logger.error("Strip %s: %s, using a linear layout", name, e)
+            layout = None
+        self.ss = SubStrip(strip, self.first_pixel, self.num_pixels, layout)
         # We store the config and hash of each config
         self._quiet = None
         self.quiet_h = None
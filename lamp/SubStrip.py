@@ -0,0 +1,117 @@
+import ctypes
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def led_buffer(strip):
+    """Return a uint32 numpy view onto the channel LED buffer of an
+    rpi_ws281x PixelStrip or None if it can't be located.
+
+    The buffer is allocated by ws2811_init() so this only works after
+    strip.begin() has been called.
+    """
+    try:
+        import _rpi_ws281x as ws
+        channel = strip._channel
+        count = ws.ws2811_channel_t_count_get(channel)
+        address = int(ws.ws2811_channel_t_leds_get(channel))
+    except (ImportError, AttributeError, TypeError) as e:
+        logger.debug("No direct access to the LED buffer: %s", e)
+        return None
+    if not address or not count:
+        return None
+    leds = (ctypes.c_uint32 * count).from_address(address)
+    return np.ctypeslib.as_array(leds)
+
+
+class SubStrip:
+    """Wraps an rpi_ws281x PixelSubStrip and adds a bulk write path.
+
+    setPixels() copies a whole array of packed 24-bit colours straight
+    into the channel's LED buffer at the substrip offset rather than
+    setting them one at a time through the SWIG binding. If the buffer
+    can't be reached it falls back to the PixelSubStrip slice path.
+
+    layout is an optional Layout.Layout: painters then see its logical
+    pixels (numPixels() is its size) and setPixels() and
+    setPixelColor() map them onto the physical ones.
+
+    Everything else is passed through to the PixelSubStrip.
+    """
+
+    def __init__(self, strip, first_pixel, num_pixels, layout=None):
+        self.strip = strip
+        self.first_pixel = first_pixel
+        self.num_pixels = num_pixels
+        self.ss = strip.createPixelSubStrip(first_pixel, num=num_pixels)
+        self.layout = layout
+        if layout is not None:
+            # The logical frame, for partial updates
+            self._frame = np.zeros(layout.size, dtype=np.uint32)
+        self._buffer = None
+        self._direct = None
+
+    def __getattr__(self, attr):
+        return getattr(self.ss, attr)
+
+    def _leds(self):
+        """Our slice of the LED buffer, looked up on first use"""
+        if self._direct is None:
+            buf = led_buffer(self.strip)
+            if (buf is not None and
+                    len(buf) >= self.first_pixel + self.num_pixels):
+                self._buffer = buf[self.first_pixel:
+                                   self.first_pixel + self.num_pixels]
+                self._direct = True
+            else:
+                logger.debug("Using slow path for substrip at %d",
+                             self.first_pixel)
+                self._direct = False
+        return self._buffer
+
+    def numPixels(self):
+        if self.layout is not None:
+            return self.layout.size
+        return self.ss.numPixels()
+
+    def setPixelColor(self, p, c):
+        if self.layout is None:
+            self.ss.setPixelColor(p, c)
+            return
+        self._frame[p] = c
+        for q in self.layout.positions(p):
+            self.ss.setPixelColor(int(q), c)
+
+    def setPixels(self, pixels, offset=0):
+        """Set len(pixels) pixels starting at offset in one go.
+
+        pixels is an array of packed 24-bit colours as returned by
+        StripShow.prepare_for_strip()
+        """
+        if self.layout is not None:
+            self._map(pixels, offset)
+            return
+        n = min(len(pixels), self.num_pixels - offset)
+        if n <= 0:
+            return
+        leds = self._leds()
+        if self._direct:
+            np.copyto(leds[offset:offset + n], pixels[:n], casting="unsafe")
+        else:
+            self.ss.setPixelColor(slice(offset, offset + n), pixels[:n])
+
+    def _map(self, pixels, offset):
+        frame = self._frame
+        n = min(len(pixels), len(frame) - offset)
+        if n <= 0:
+            return
+        np.copyto(frame[offset:offset + n], pixels[:n], casting="unsafe")
+        leds = self._leds()
+        if self._direct:
+            self.layout.map(frame, out=leds)
+        else:
+            self.ss.setPixelColor(slice(0, self.num_pixels),
+                                  self.layout.map(frame))
@@ -0,0 +1,74 @@
+"""Try the lamp.Clock sync with a stand in for the broker which delays
+each message by a random amount. A master publishes references to two
+peers with drifting, offset clocks and the error, drift and jitter
+each peer settles on are printed.
+
+Run it from the top of the tree:
+    python tools/clock_sync.py
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lamp.Clock import SharedClock  # noqa: E402
+
+
+class LocalBroker:
+    def __init__(self, min_delay=0.001, max_delay=0.020):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.subscribers = []
+
+    def subscribe(self, handler):
+        self.subscribers.append(handler)
+
+    def publish(self, topic, payload):
+        loop = asyncio.get_running_loop()
+        for handler in self.subscribers:
+            delay = random.uniform(self.min_delay, self.max_delay)
+            loop.call_later(delay, handler, payload)
+
+
+async def simulate(seconds=40.0, interval=0.25, window=128):
+    broker = LocalBroker()
+    master = SharedClock("master")
+    peers = []
+    for drift, offset in ((100e-6, 1234.5), (-80e-6, -42.0)):
+        start = time.monotonic()
+        peer = SharedClock(
+            "peer", window,
+            clock=lambda d=drift, o=offset, s=start:
+            o + (time.monotonic() - s) * (1 + d))
+        broker.subscribe(peer.handle)
+        peers.append(peer)
+    task = asyncio.create_task(
+        master.run(broker.publish, "clock", interval))
+    await asyncio.sleep(seconds)
+    task.cancel()
+    now = time.time()
+    times = [p.time() for p in peers]
+    for i, (peer, t) in enumerate(zip(peers, times)):
+        print(f"peer {i}: error {(t - now) * 1000:+.2f}ms "
+              f"drift {peer.drift * 1e6:+.1f}ppm "
+              f"jitter {peer.jitter * 1000:.2f}ms")
+    print(f"inter-lamp skew {abs(times[0] - times[1]) * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=40.0)
+    parser.add_argument("--interval", type=float, default=0.25,
+                        help="seconds between master references")
+    parser.add_argument("--window", type=int, default=128,
+                        help="references each peer keeps")
+    args = parser.parse_args()
+    asyncio.run(simulate(args.seconds, args.interval, args.window))
+
+
+if __name__ == "__main__":
+    main()
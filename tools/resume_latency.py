@@ -0,0 +1,95 @@
+"""Measure how long music painters wait for audio after a pause, with
+and without the capture stream lingering (config.MIC_LINGER).
+
+Each trial subscribes, unsubscribes, waits pause seconds (shorter than
+the linger) and subscribes again, like an mpd pause and play. It
+reports the time from the resubscribe to:
+  first  : the first new audio block
+  window : an analysis window holding only audio captured since the
+           stream (re)started; a lingering stream already has one so
+           this is the same as first
+
+Run it from the top of the tree, on the lamp for real figures:
+    python tools/resume_latency.py --source pyaudio
+The default synthetic source opens instantly so it measures only the
+capture thread and block timing.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audiosource  # noqa: E402
+import config  # noqa: E402
+import dsp  # noqa: E402
+
+
+async def wait_for_seq(source, seq):
+    while source.seq < seq:
+        await source.next_block(source.seq, timeout=5.0)
+
+
+async def trial(source, client, pause, blocks_per_window):
+    await source.unsubscribe_stream(client)
+    # Up to a block more so the resubscribe isn't in step with blocks
+    await asyncio.sleep(pause + random.uniform(0, dsp.hop_samples() /
+                                               config.MIC_RATE))
+    task = source.stream_playing_task
+    lingering = task is not None and not task.done()
+    seq = source.seq
+    start = time.monotonic()
+    await source.subscribe_stream(client)
+    await wait_for_seq(source, seq + 1)
+    first = time.monotonic() - start
+    if not lingering:
+        await wait_for_seq(source, seq + blocks_per_window)
+    return first, time.monotonic() - start
+
+
+async def measure(spec, linger, pause, trials):
+    hop = dsp.hop_samples()
+    window = dsp.window_samples()
+    blocks_per_window = -(-window // hop)
+    source = audiosource.create_source(spec, config.MIC_RATE, hop,
+                                       history=window, linger=linger)
+    client = object()
+    await source.subscribe_stream(client)
+    await wait_for_seq(source, blocks_per_window)
+    results = [await trial(source, client, pause, blocks_per_window)
+               for i in range(trials)]
+    await source.close()
+    return results
+
+
+def report(name, values):
+    ms = [v * 1000 for v in values]
+    print(f"  {name:7s} median {statistics.median(ms):6.1f}ms "
+          f"max {max(ms):6.1f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source", default="synthetic",
+                        help="audio source spec (see create_source)")
+    parser.add_argument("--linger", type=float, default=5.0,
+                        help="linger seconds to compare with none")
+    parser.add_argument("--pause", type=float, default=1.0,
+                        help="seconds between unsubscribe and subscribe")
+    parser.add_argument("--trials", type=int, default=20)
+    args = parser.parse_args()
+    print(f"{args.source}: hop {dsp.hop_samples()}, window "
+          f"{dsp.window_samples()} samples at {config.MIC_RATE} Hz")
+    for linger in (0, args.linger):
+        results = await measure(args.source, linger, args.pause, args.trials)
+        print(f"linger {linger}s:")
+        report("first", [first for first, window in results])
+        report("window", [window for first, window in results])
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class _NoSpan:
+    """Returned by span() when not recording so disabled tracing is
+    one attribute test and a no-op with block"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "cat", "start")
+
+    def __init__(self, tracer, name, cat):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.cat, self.start,
+                        time.perf_counter_ns() - self.start)
+        return False
+
+
+class Tracer:
+    """Records named spans of time for export as Chrome trace events
+    (load the JSON in chrome://tracing or ui.perfetto.dev).
+
+        with tracer.span("fft", "audio"):
+            ...
+
+    Spans are only recorded between enable() and disable(). With a
+    sample of n only one frame in n is recorded: the show loop calls
+    frame() once per frame and spans from any thread follow the
+    current frame's choice. The most recent capacity spans are kept.
+    """
+
+    def __init__(self, capacity=100000):
+        self.enabled = False
+        self.recording = False
+        self.sample = 1
+        self._frame = 0
+        self._t0 = time.perf_counter_ns()
+        self.events = deque(maxlen=capacity)
+        self._threads = {}
+
+    def enable(self, sample=1):
+        self.sample = max(int(sample), 1)
+        self._frame = 0
+        self.events.clear()
+        self.enabled = True
+        self.recording = True
+        logger.info("Tracing enabled, sampling 1 frame in %d", self.sample)
+
+    def disable(self):
+        self.enabled = False
+        self.recording = False
+
+    def frame(self):
+        """Mark the start of a frame and decide if it is sampled"""
+        if self.enabled:
+            self._frame += 1
+            self.recording = self._frame % self.sample == 0
+
+    def span(self, name, cat="lamp"):
+        if not self.recording:
+            return NO_SPAN
+        return _Span(self, name, cat)
+
+    def add(self, name, cat, start, duration):
+        """Record a span from its perf_counter_ns() start and length"""
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads[tid] = threading.current_thread().name
+        self.events.append((name, cat, start, duration, tid))
+
+    def export(self, seconds=None):
+        """Return the Chrome trace event dict for the last seconds of
+        recorded spans (or all of them)"""
+        pid = os.getpid()
+        events = list(self.events)
+        if seconds is not None:
+            since = time.perf_counter_ns() - int(seconds * 1e9)
+            events = [e for e in events if e[2] >= since]
+        trace = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                  "args": {"name": name}}
+                 for tid, name in list(self._threads.items())]
+        trace += [{"name": name, "cat": cat, "ph": "X", "pid": pid,
+                   "tid": tid, "ts": (start - self._t0) / 1000,
+                   "dur": duration / 1000}
+                  for name, cat, start, duration, tid in events]
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    @staticmethod
+    def dump(trace, path):
+        """Write an export() to path as JSON. Safe to call in a thread."""
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        logger.info("Wrote %d trace events to %s",
+                    len(trace["traceEvents"]), path)
+
+
+tracer = Tracer()
+"""The process wide tracer"""